@@ -54,16 +54,22 @@ class CollationHeader(rlp.Serializable):
         assert len(fields['coinbase']) == 20
         super(CollationHeader, self).__init__(**fields)
 
-    def __getattribute__(self, name):
-        try:
-            return rlp.Serializable.__getattribute__(self, name)
-        except AttributeError:
-            return getattr(self.header, name)
+    def __setattr__(self, name, value):
+        super(CollationHeader, self).__setattr__(name, value)
+        # Drop the memoized hashes whenever a field is mutated
+        if name in _header_field_names:
+            self.__dict__.pop('_cached_hash', None)
+            if name != 'sig':
+                self.__dict__.pop('_cached_signing_hash', None)
 
     @property
     def hash(self):
         """The binary collation hash"""
-        return utils.sha3(rlp.encode(self))
+        h = self.__dict__.get('_cached_hash')
+        if h is None:
+            h = utils.sha3(rlp.encode(self))
+            self.__dict__['_cached_hash'] = h
+        return h
 
     @property
     def hex_hash(self):
@@ -71,7 +77,12 @@ class CollationHeader(rlp.Serializable):
 
     @property
     def signing_hash(self):
-        return utils.sha3(rlp.encode(self, CollationHeader.exclude(['sig'])))
+        """The hash of the header without the signature"""
+        h = self.__dict__.get('_cached_signing_hash')
+        if h is None:
+            h = utils.sha3(rlp.encode(self, UnsignedCollationHeader))
+            self.__dict__['_cached_signing_hash'] = h
+        return h
 
     def to_dict(self):
         """Serialize the header to a readable dictionary."""
@@ -89,7 +100,7 @@ class CollationHeader(rlp.Serializable):
         return d
 
     def __repr__(self):
-        return '<%s(#%d %s)>' % (self.__class__.__name__, self.number,
+        return '<%s(#%d %s)>' % (self.__class__.__name__, self.shard_id,
                                  encode_hex(self.hash)[:8])
 
     def __eq__(self, other):
@@ -103,6 +114,22 @@ class CollationHeader(rlp.Serializable):
         return not self.__eq__(other)
 
 
+_header_field_names = frozenset(field for field, _ in CollationHeader.fields)
+UnsignedCollationHeader = CollationHeader.exclude(['sig'])
+
+
+def _header_property(name, read_only=False):
+    """Make a property of Collation which reads and writes `header.<name>`,
+    or only reads it if read_only"""
+    def fget(self):
+        return getattr(self.header, name)
+
+    def fset(self, value):
+        setattr(self.header, name, value)
+
+    return property(fget) if read_only else property(fget, fset)
+
+
 class Collation(rlp.Serializable):
     """A collation.
 
@@ -122,11 +149,23 @@ class Collation(rlp.Serializable):
         self.header = header
         self.transactions = transactions or []
 
-    def __getattribute__(self, name):
-        try:
-            return rlp.Serializable.__getattribute__(self, name)
-        except AttributeError:
-            return getattr(self.header, name)
+    # Header fields are delegated to `self.header`
+    shard_id = _header_property('shard_id')
+    expected_period_number = _header_property('expected_period_number')
+    period_start_prevhash = _header_property('period_start_prevhash')
+    parent_collation_hash = _header_property('parent_collation_hash')
+    tx_list_root = _header_property('tx_list_root')
+    coinbase = _header_property('coinbase')
+    post_state_root = _header_property('post_state_root')
+    receipts_root = _header_property('receipts_root')
+    sig = _header_property('sig')
+    hash = _header_property('hash', read_only=True)
+    hex_hash = _header_property('hex_hash', read_only=True)
+    signing_hash = _header_property('signing_hash', read_only=True)
+
+    def to_dict(self):
+        """Serialize the header to a readable dictionary."""
+        return self.header.to_dict()
 
     @property
     def transaction_count(self):
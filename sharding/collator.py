@@ -2,22 +2,64 @@ import rlp
 
 from ethereum.slogging import get_logger
 from ethereum.consensus_strategy import get_consensus_strategy
+from ethereum.exceptions import (InsufficientBalance, BlockGasLimitReached, InsufficientStartGas,
+                                 InvalidNonce, UnsignedTransaction)
 from ethereum.messages import apply_transaction
 from ethereum.common import mk_block_from_prevstate
 from ethereum.utils import big_endian_to_int
 
 from sharding import state_transition
-from sharding.validator_manager_utils import (sign, call_msg_add_header)
+from sharding.validator_manager_utils import (sign, call_msg_add_header, apply_msg_add_header)
 from sharding.collation import CollationHeader
+from sharding.validator_manager_view import ValidatorManagerView
 
 log = get_logger('sharding.collator')
 
+# CONSENSUS_STRATEGY of a config -> consensus strategy
+_consensus_strategies = {}
+
+
+def consensus_strategy(config):
+    """get_consensus_strategy, created once for each CONSENSUS_STRATEGY
+
+    The strategy only depends on the name in config, so there is one entry
+    per known strategy however many configs are used.
+    """
+    name = config['CONSENSUS_STRATEGY']
+    if name not in _consensus_strategies:
+        _consensus_strategies[name] = get_consensus_strategy(config)
+    return _consensus_strategies[name]
+
+
+class PeriodContext(object):
+    """The period_start_prevblock and the consensus strategy of a period,
+    shared by all the collations of the period in every shard
+
+    chain: MainChain
+    period_number: the expected period number
+    """
+
+    def __init__(self, chain, period_number):
+        self.period_number = period_number
+        block_number = chain.env.config['PERIOD_LENGTH'] * period_number - 1
+        self.period_start_prevhash = chain.get_blockhash_by_number(block_number)
+        if self.period_start_prevhash is None:
+            self.period_start_prevblock = None
+        else:
+            self.period_start_prevblock = chain.get_block(self.period_start_prevhash)
+        self.cs = consensus_strategy(chain.env.config)
+
+    def initialize(self, state):
+        """Call the initialize state transition function with period_start_prevblock
+        """
+        self.cs.initialize(state, self.period_start_prevblock)
+
 
 def apply_collation(state, collation, period_start_prevblock):
     """Apply collation
     """
     snapshot = state.snapshot()
-    cs = get_consensus_strategy(state.config)
+    cs = consensus_strategy(state.config)
 
     try:
         # Call the initialize state transition function
@@ -36,6 +78,112 @@ def apply_collation(state, collation, period_start_prevblock):
     return state
 
 
+class CollationBuilder(object):
+    """Keep a candidate collation of a shard up to date before it is sealed
+
+    The candidate is built on top of a parent collation for an expected period
+    number. Transactions are applied as they arrive, and the execution results
+    of the finalized candidate are updated each time, so `seal` only has to
+    sign the header.
+
+    chain: MainChain
+    shard_id: id of ShardChain
+    coinbase: coinbase
+    """
+
+    def __init__(self, chain, shard_id, coinbase):
+        assert chain.has_shard(shard_id)
+        if shard_id not in chain.shards:
+            raise ValueError('The state of shard %d is in a worker of the shard executor' % shard_id)
+        self.chain = chain
+        self.shard_id = shard_id
+        self.coinbase = coinbase
+        self.parent_collation_hash = None
+        self.expected_period_number = None
+        self.state = None
+        self.collation = None
+
+    def reset(self, parent_collation_hash, expected_period_number):
+        """Start a candidate on top of the parent collation
+
+        The transactions of the previous candidate, which are already popped
+        from their txqueue, are applied again to the new one. The candidate
+        state is an ephemeral clone, so nothing is written to the shard db.
+        """
+        shard = self.chain.shards[self.shard_id]
+        state = shard.mk_poststate_of_collation_hash(parent_collation_hash).ephemeral_clone()
+        transactions = self.collation.transactions if self.collation is not None else []
+
+        # Set period_start_prevblock info
+        period = self.chain.get_period_context(expected_period_number)
+        assert period.period_start_prevhash is not None
+        period_start_prevhash = period.period_start_prevhash
+        # Call the initialize state transition function
+        period.initialize(state)
+        # Initialize a collation with the given previous state and current coinbase
+        collation = state_transition.mk_collation_from_prevstate(shard, state, self.coinbase)
+        collation.header.parent_collation_hash = parent_collation_hash
+        collation.header.expected_period_number = expected_period_number
+        collation.header.period_start_prevhash = period_start_prevhash
+
+        self.parent_collation_hash = parent_collation_hash
+        self.expected_period_number = expected_period_number
+        self.state = state
+        self.collation = collation
+        for tx in transactions:
+            try:
+                apply_transaction(state, tx)
+                collation.transactions.append(tx)
+            except (InsufficientBalance, BlockGasLimitReached, InsufficientStartGas,
+                    InvalidNonce, UnsignedTransaction) as e:
+                log.info('Dropped transaction of the previous candidate: {}'.format(str(e)))
+        self._preseal()
+
+    def is_candidate_of(self, parent_collation_hash, expected_period_number):
+        return self.collation is not None and \
+            self.parent_collation_hash == parent_collation_hash and \
+            self.expected_period_number == expected_period_number
+
+    def add_transactions(self, txqueue):
+        """Apply the transactions in txqueue to the candidate
+        """
+        transaction_count = len(self.collation.transactions)
+        state_transition.add_transactions(self.state, self.collation, txqueue)
+        if len(self.collation.transactions) > transaction_count:
+            self._preseal()
+
+    def _preseal(self):
+        # Set the execution results of the finalized candidate, and keep the
+        # state unfinalized for the next transactions
+        self.state.commit()
+        snapshot = self.state.snapshot()
+        # Call the finalize state transition function
+        state_transition.finalize(self.state, self.collation.header.coinbase)
+        # Set state root, receipt root, etc
+        state_transition.set_execution_results(self.state, self.collation)
+        self.state.revert(snapshot)
+
+    def seal(self, parent_collation_hash, expected_period_number, key):
+        """Sign and return the candidate, which is built again with its
+        transactions if it is not on top of parent_collation_hash for
+        expected_period_number
+        """
+        if not self.is_candidate_of(parent_collation_hash, expected_period_number):
+            self.reset(parent_collation_hash, expected_period_number)
+        collation = self.collation
+
+        try:
+            sig = sign(collation.signing_hash, key)
+            collation.header.sig = sig
+        except Exception as e:
+            log.info('Failed to sign collation, exception: {}'.format(str(e)))
+            raise e
+
+        # The sealed collation is not a candidate anymore
+        self.collation = self.state = None
+        return collation
+
+
 def create_collation(
         chain,
         shard_id,
@@ -56,37 +204,11 @@ def create_collation(
     """
     log.info('Creating a collation')
 
-    assert chain.has_shard(shard_id)
-
-    temp_state = chain.shards[shard_id].mk_poststate_of_collation_hash(parent_collation_hash)
-    cs = get_consensus_strategy(temp_state.config)
-
-    # Set period_start_prevblock info
-    period_start_prevhash = chain.get_period_start_prevhash(expected_period_number)
-    assert period_start_prevhash is not None
-    period_start_prevblock = chain.get_block(period_start_prevhash)
-    # Call the initialize state transition function
-    cs.initialize(temp_state, period_start_prevblock)
-    # Initialize a collation with the given previous state and current coinbase
-    collation = state_transition.mk_collation_from_prevstate(chain.shards[shard_id], temp_state, coinbase)
+    builder = CollationBuilder(chain, shard_id, coinbase)
+    builder.reset(parent_collation_hash, expected_period_number)
     # Add transactions
-    state_transition.add_transactions(temp_state, collation, txqueue)
-    # Call the finalize state transition function
-    state_transition.finalize(temp_state, collation.header.coinbase)
-    # Set state root, receipt root, etc
-    state_transition.set_execution_results(temp_state, collation)
-
-    collation.header.shard_id = shard_id
-    collation.header.parent_collation_hash = parent_collation_hash
-    collation.header.expected_period_number = expected_period_number
-    collation.header.period_start_prevhash = period_start_prevhash
-
-    try:
-        sig = sign(collation.signing_hash, key)
-        collation.header.sig = sig
-    except Exception as e:
-        log.info('Failed to sign collation, exception: {}'.format(str(e)))
-        raise e
+    builder.add_transactions(txqueue)
+    collation = builder.seal(parent_collation_hash, expected_period_number, key)
 
     log.info('Created collation successfully')
     return collation
@@ -100,22 +222,60 @@ def verify_collation_header(chain, header):
     chain: MainChain
     header: the given collation header
     """
-    if header.shard_id < 0:
-        raise ValueError('Invalid shard_id %d' % header.shard_id)
+    return _verify_collation_header(mk_header_verification_state(chain), header)
+
 
-    # Call contract to verify header
+def verify_collation_headers(chain, headers):
+    """Verify many collation headers, e.g. the headers of a block
+
+    The state to call add_header on is set up once, and every valid header
+    is added to it, so a header can follow its parent in the same batch and
+    a repeated header is rejected like add_header of the contract does.
+
+    chain: MainChain
+    headers: the given collation headers
+
+    Return a list of whether each header is valid
+    """
+    state = mk_header_verification_state(chain)
+    results = []
+    for header in headers:
+        try:
+            results.append(_verify_collation_header(state, header, apply_header=True))
+        except ValueError as e:
+            log.info('Invalid collation header %s, reason: %s' % (header, str(e)))
+            results.append(False)
+    return results
+
+
+def mk_header_verification_state(chain):
+    """Make the state of a new block on top of the main chain head to call add_header on
+    """
     state = chain.state.ephemeral_clone()
     block = mk_block_from_prevstate(chain, timestamp=chain.state.timestamp + 14)
-    cs = get_consensus_strategy(state.config)
+    cs = consensus_strategy(state.config)
     cs.initialize(state, block)
+    return state
+
+
+def _verify_collation_header(state, header, apply_header=False):
+    # Reject the bad headers before running the contract
+    try:
+        ValidatorManagerView(state).check_add_header(header)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError('Checking the header is failed: %s' % str(e))
 
+    # Call contract to verify header, call_msg_add_header runs on a clone of state
+    # and apply_msg_add_header adds the header to state
+    add_header = apply_msg_add_header if apply_header else call_msg_add_header
     try:
-        result = call_msg_add_header(
+        result = add_header(
             state, 0, rlp.encode(CollationHeader.serialize(header)), header.coinbase)
         result = bool(big_endian_to_int(result))
-        print('result:{}'.format(result))
-        if not result:
-            raise ValueError('Calling add_header returns False')
-    except:
+    except Exception:
         raise ValueError('Calling add_header is failed')
+    if not result:
+        raise ValueError('Calling add_header returns False')
     return True
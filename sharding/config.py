@@ -10,15 +10,10 @@ sharding_config["ANTI_DOS_FORK_BLKNUM"] = 0
 sharding_config["SPURIOUS_DRAGON_FORK_BLKNUM"] = 0
 sharding_config["METROPOLIS_FORK_BLKNUM"] = 2**99
 sharding_config['SHARD_COUNT'] = 100
-# valmgr_addr: should be modified whenever "the v, r, s in valmgr tx" or
-# "the content of the contract" change
-# TODO: Should we just call the sharding.validator_manager.get_valmgr_addr()
-#       to determine the valmgr address here for now? Or add a check in
-#       test_validator_manager.py to check if
-#       `sharding_config['VALIDATOR_MANAGER_ADDRESS']` equals to
-#       `utils.checksum_encode(get_valmgr_addr())`?
-#       Because currently we modify the contract so frequently.
-sharding_config['VALIDATOR_MANAGER_ADDRESS'] = '0x24AA7958EDff44E6FDac252Ee1945B6326Af4b6E'
+# valmgr_addr: depends on "the v, r, s in valmgr tx" and "the content of the
+# contract", so it is set from the compiled contract by
+# sharding.validator_manager_utils.create_valmgr_tx, see get_valmgr_addr()
+sharding_config['VALIDATOR_MANAGER_ADDRESS'] = ''
 sharding_config['USED_RECEIPT_STORE_ADDRESS'] = ''    # TODO
 sharding_config['SIG_GASLIMIT'] = 40000
 sharding_config['COLLATOR_REWARD'] = 0.002 * utils.denoms.ether
@@ -15,13 +15,12 @@ collation_headers: public({
 
 shard_head: public(bytes32[num])
 
+# validators are packed in the indexes [0, num_validators)
 num_validators: public(num)
 
-# indexs of empty slots caused by the function `withdraw`
-empty_slots_stack: num[num]
-
-# the top index of the stack in empty_slots_stack
-empty_slots_stack_top: num
+# incremented by every deposit and withdrawal, so that a copy of the
+# validators kept off-chain knows when to read them again
+registry_nonce: num
 
 # the exact deposit size which you have to deposit to become a validator
 deposit_size: wei_value
@@ -35,6 +34,10 @@ sig_gas_limit: num
 # is a valcode addr deposited now?
 is_valcode_deposited: bool[address]
 
+# the current index of a deposited valcode addr, which changes when the last
+# validator is moved into a withdrawn slot
+validator_index_of: public(num[address])
+
 period_length: num
 
 num_validators_per_cycle: num
@@ -47,7 +50,6 @@ sighasher_addr: address
 
 def __init__():
     self.num_validators = 0
-    self.empty_slots_stack_top = 0
     # 10 ** 20 wei = 100 ETH
     self.deposit_size = 100000000000000000000
     self.shuffling_cycle_length = 2500
@@ -59,35 +61,11 @@ def __init__():
     self.sighasher_addr = 0xDFFD41E18F04Ad8810c83B14FD1426a82E625A7D
 
 
-def is_stack_empty() -> bool:
-    return (self.empty_slots_stack_top == 0)
-
-
-def stack_push(index: num):
-    self.empty_slots_stack[self.empty_slots_stack_top] = index
-    self.empty_slots_stack_top += 1
-
-
-def stack_pop() -> num:
-    if self.is_stack_empty():
-        return -1
-    self.empty_slots_stack_top -= 1
-    return self.empty_slots_stack[self.empty_slots_stack_top]
-
-
-def get_validators_max_index() -> num:
-    return self.num_validators + self.empty_slots_stack_top
-
-
 @payable
 def deposit(validation_code_addr: address, return_addr: address) -> num:
     assert not self.is_valcode_deposited[validation_code_addr]
     assert msg.value == self.deposit_size
-    # find the empty slot index in validators set
-    if not self.is_stack_empty():
-        index = self.stack_pop()
-    else:
-        index = self.num_validators
+    index = self.num_validators
     self.validators[index] = {
         deposit: msg.value,
         validation_code_addr: validation_code_addr,
@@ -95,6 +73,8 @@ def deposit(validation_code_addr: address, return_addr: address) -> num:
     }
     self.num_validators += 1
     self.is_valcode_deposited[validation_code_addr] = True
+    self.validator_index_of[validation_code_addr] = index
+    self.registry_nonce += 1
     return index
 
 
@@ -103,14 +83,24 @@ def withdraw(validator_index: num, sig: bytes <= 1000) -> bool:
     result = (extract32(raw_call(self.validators[validator_index].validation_code_addr, concat(msg_hash, sig), gas=self.sig_gas_limit, outsize=32), 0) == as_bytes32(1))
     if result:
         send(self.validators[validator_index].return_addr, self.validators[validator_index].deposit)
-        self.is_valcode_deposited[self.validators[validator_index].validation_code_addr] = False
+        withdrawn_addr = self.validators[validator_index].validation_code_addr
+        self.is_valcode_deposited[withdrawn_addr] = False
+        # Move the last validator into the withdrawn slot to keep the validators packed
+        last_index = self.num_validators - 1
+        self.validator_index_of[self.validators[last_index].validation_code_addr] = validator_index
+        self.validator_index_of[withdrawn_addr] = 0
         self.validators[validator_index] = {
+            deposit: self.validators[last_index].deposit,
+            validation_code_addr: self.validators[last_index].validation_code_addr,
+            return_addr: self.validators[last_index].return_addr
+        }
+        self.validators[last_index] = {
             deposit: 0,
             validation_code_addr: None,
             return_addr: None
         }
-        self.stack_push(validator_index)
         self.num_validators -= 1
+        self.registry_nonce += 1
     return result
 
 
@@ -129,17 +119,12 @@ def sample(shard_id: num) -> address:
     seed = blockhash(block.number - (block.number % self.period_length) - 1)
     index_in_subset = num256_mod(as_num256(sha3(concat(seed, as_bytes32(shard_id)))),
                                  as_num256(self.num_validators_per_cycle))
-    if self.num_validators != 0:
-        # TODO: here we assume this fixed number of rounds is enough to sample
-        #       a validator
-        for i in range(1024):
-            validator_index = num256_mod(as_num256(sha3(concat(cycle_seed, as_bytes32(shard_id), as_bytes32(index_in_subset), as_bytes32(i)))),
-                                         as_num256(self.get_validators_max_index()))
-            addr = self.validators[as_num128(validator_index)].validation_code_addr
-            if addr != zero_addr:
-                return addr
-
-    return zero_addr
+    if self.num_validators == 0:
+        return zero_addr
+    # There is no empty slot below num_validators, so the first sampled index is a validator
+    validator_index = num256_mod(as_num256(sha3(concat(cycle_seed, as_bytes32(shard_id), as_bytes32(index_in_subset)))),
+                                 as_num256(self.num_validators))
+    return self.validators[as_num128(validator_index)].validation_code_addr
 
 
 # Attempts to process a collation header, returns True on success, reverts on failure.
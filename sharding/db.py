@@ -0,0 +1,340 @@
+import os
+import mmap
+import struct
+
+from ethereum.db import BaseDB, OverlayDB
+
+
+class WriteBatch(OverlayDB):
+    """Buffer the writes to a db and apply them with one commit
+    (refer to ethereum.db.OverlayDB)
+
+    Reads see the buffered writes first, then the underlying db.
+    """
+
+    def __init__(self, db):
+        super(WriteBatch, self).__init__(db)
+        self.collation_keys = set()
+
+    def put_collation(self, key, value):
+        """Put a collation RLP, which goes to the collation segments of a ShardDB
+        """
+        self.collation_keys.add(key)
+        self.put(key, value)
+
+    def commit(self):
+        for key, value in self.overlay.items():
+            if value is None:
+                if key in self.db:
+                    self.db.delete(key)
+            elif key in self.collation_keys and hasattr(self.db, 'put_collation'):
+                self.db.put_collation(key, value)
+            else:
+                self.db.put(key, value)
+        self.overlay = {}
+        self.collation_keys = set()
+        self.db.commit()
+
+    def __len__(self):
+        return len(self.overlay)
+
+
+# Record header: flags, key length, value length
+RECORD_HEADER = struct.Struct('>BHI')
+KEY_STR = 1         # the key was a str
+VALUE_STR = 2       # the value was a str
+TOMBSTONE = 4       # the key is deleted
+
+# Hint file of a full segment: the segment size, then the records without
+# their values, each with a header of flags, key length, value offset, value length
+HINT_SEGMENT_SIZE = struct.Struct('>Q')
+HINT_HEADER = struct.Struct('>BHII')
+
+
+class SegmentDB(BaseDB):
+    """Append-only key-value store in segment files of a directory
+
+    Every put or delete appends a record to the last segment, and a new
+    segment is started once it grows over `segment_size` bytes. Only the
+    location of each value is kept in memory, the values are read from the
+    segments through mmap.
+
+    When a segment is full, the locations of its records are written to a
+    hint file next to it. The index is loaded from the hint files when the
+    store is opened, only the last segment and the segments without a valid
+    hint file are scanned, and a record torn by a crash is cut off.
+
+    Writes are buffered until commit. `compact` rewrites the live records to
+    reclaim the space of overwritten and deleted values.
+
+    The index is not paged, it holds every live key with its location in
+    memory, so the memory grows with the number of keys (roughly 300 bytes
+    for a 32-byte key). The hint files only speed up opening the store, a
+    store with more keys than fit in memory needs another backend.
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        self.kv = None
+        self.index = {}         # key -> (segment number, value offset, value length, flags)
+        self.uncommitted = {}   # key -> value, None for deletes
+        self.maps = {}          # segment number -> mmap
+        self.hints = []         # (flags, key, value offset, value length) of the records of the last segment
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.segments = sorted(
+            int(name[:-4]) for name in os.listdir(path) if name.endswith('.seg'))
+        for segment in self.segments:
+            self.hints = self._load_segment(segment)
+        if not self.segments:
+            self.segments.append(0)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '%08d.seg' % segment)
+
+    def _hint_path(self, segment):
+        return os.path.join(self.path, '%08d.hint' % segment)
+
+    def _load_segment(self, segment):
+        """Add the records of a segment to the index and return their hints
+        """
+        hints = self._read_hints(segment)
+        if hints is None:
+            hints = self._scan_segment(segment)
+        for flags, key, value_offset, value_length in hints:
+            if flags & TOMBSTONE:
+                self.index.pop(key, None)
+            else:
+                self.index[key] = (segment, value_offset, value_length, flags)
+        return hints
+
+    def _scan_segment(self, segment):
+        path = self._segment_path(segment)
+        size = os.path.getsize(path)
+        offset = 0
+        hints = []
+        if size > 0:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                while offset + RECORD_HEADER.size <= size:
+                    flags, key_length, value_length = RECORD_HEADER.unpack_from(data, offset)
+                    key_offset = offset + RECORD_HEADER.size
+                    value_offset = key_offset + key_length
+                    if value_offset + value_length > size:
+                        break
+                    key = data[key_offset: value_offset]
+                    if flags & KEY_STR:
+                        key = key.decode('utf-8')
+                    hints.append((flags, key, value_offset, value_length))
+                    offset = value_offset + value_length
+            finally:
+                data.close()
+        if offset < size:
+            # Cut off the record torn by a crash
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        return hints
+
+    def _read_hints(self, segment):
+        """Read the hint file of a segment, None if it is missing or doesn't match the segment
+        """
+        path = self._hint_path(segment)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        try:
+            segment_size, = HINT_SEGMENT_SIZE.unpack_from(data, 0)
+            if segment_size != os.path.getsize(self._segment_path(segment)):
+                return None
+            hints = []
+            offset = HINT_SEGMENT_SIZE.size
+            while offset < len(data):
+                flags, key_length, value_offset, value_length = HINT_HEADER.unpack_from(data, offset)
+                offset += HINT_HEADER.size
+                key = data[offset: offset + key_length]
+                if len(key) < key_length:
+                    return None
+                if flags & KEY_STR:
+                    key = key.decode('utf-8')
+                hints.append((flags, key, value_offset, value_length))
+                offset += key_length
+        except (struct.error, UnicodeDecodeError):
+            return None
+        return hints
+
+    def _write_hints(self, segment, hints):
+        path = self._hint_path(segment)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(HINT_SEGMENT_SIZE.pack(os.path.getsize(self._segment_path(segment))))
+            for flags, key, value_offset, value_length in hints:
+                if flags & KEY_STR:
+                    key = key.encode('utf-8')
+                f.write(HINT_HEADER.pack(flags, len(key), value_offset, value_length))
+                f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+    def _read(self, location):
+        segment, offset, length, flags = location
+        data = self.maps.get(segment)
+        if data is None or len(data) < offset + length:
+            if data is not None:
+                data.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                data = self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        value = data[offset: offset + length]
+        if flags & VALUE_STR:
+            value = value.decode('utf-8')
+        return value
+
+    def get(self, key):
+        if key in self.uncommitted:
+            value = self.uncommitted[key]
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self._read(self.index[key])
+
+    def put(self, key, value):
+        self.uncommitted[key] = value
+
+    def delete(self, key):
+        self.uncommitted[key] = None
+
+    def commit(self):
+        if not self.uncommitted:
+            return
+        self._append(self.uncommitted.items())
+        self.uncommitted = {}
+
+    def _append(self, items):
+        segment = self.segments[-1]
+        f = open(self._segment_path(segment), 'ab')
+        try:
+            position = f.tell()
+            for key, value in items:
+                if position >= self.segment_size:
+                    self._sync(f)
+                    self._write_hints(segment, self.hints)
+                    self.hints = []
+                    segment += 1
+                    self.segments.append(segment)
+                    f = open(self._segment_path(segment), 'ab')
+                    position = 0
+                flags = 0
+                if not isinstance(key, bytes):
+                    key = key.encode('utf-8')
+                    flags |= KEY_STR
+                    index_key = key.decode('utf-8')
+                else:
+                    index_key = key
+                if value is None:
+                    if index_key not in self.index:
+                        continue
+                    flags |= TOMBSTONE
+                    value = b''
+                elif not isinstance(value, bytes):
+                    value = value.encode('utf-8')
+                    flags |= VALUE_STR
+                f.write(RECORD_HEADER.pack(flags, len(key), len(value)))
+                f.write(key)
+                f.write(value)
+                value_offset = position + RECORD_HEADER.size + len(key)
+                position = value_offset + len(value)
+                self.hints.append((flags, index_key, value_offset, len(value)))
+                if flags & TOMBSTONE:
+                    del self.index[index_key]
+                else:
+                    self.index[index_key] = (segment, value_offset, len(value), flags)
+        finally:
+            self._sync(f)
+
+    def _sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def compact(self):
+        """Rewrite the live records into new segments and remove the old ones
+        """
+        self.commit()
+        old_segments = self.segments
+        locations = list(self.index.items())
+        self.segments = [old_segments[-1] + 1]
+        self.hints = []
+        # The values are read one at a time while they are appended
+        self._append((key, self._read(location)) for key, location in locations)
+        self.close()
+        for segment in old_segments:
+            os.remove(self._segment_path(segment))
+            if os.path.exists(self._hint_path(segment)):
+                os.remove(self._hint_path(segment))
+
+    def close(self):
+        for data in self.maps.values():
+            data.close()
+        self.maps = {}
+
+    def _has_key(self, key):
+        if key in self.uncommitted:
+            return self.uncommitted[key] is not None
+        return key in self.index
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+    def __len__(self):
+        return len(self.index)
+
+
+class ShardDB(BaseDB):
+    """On-disk db of a node, with the collation RLPs and the other data
+    (trie nodes, scores, journals) in separate segment stores
+
+    The collations are written by put_collation, which WriteBatch forwards to.
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024):
+        self.path = path
+        self.kv = None
+        self.collations = SegmentDB(os.path.join(path, 'collations'), segment_size)
+        self.state = SegmentDB(os.path.join(path, 'state'), segment_size)
+
+    def get(self, key):
+        if key in self.collations:
+            return self.collations.get(key)
+        return self.state.get(key)
+
+    def put(self, key, value):
+        self.state.put(key, value)
+
+    def put_collation(self, key, value):
+        self.collations.put(key, value)
+
+    def delete(self, key):
+        if key in self.collations:
+            self.collations.delete(key)
+        else:
+            self.state.delete(key)
+
+    def commit(self):
+        self.collations.commit()
+        self.state.commit()
+
+    def compact(self):
+        self.collations.compact()
+        self.state.compact()
+
+    def close(self):
+        self.collations.close()
+        self.state.close()
+
+    def _has_key(self, key):
+        return key in self.collations or key in self.state
+
+    def __contains__(self, key):
+        return self._has_key(key)
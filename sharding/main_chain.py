@@ -1,8 +1,11 @@
 from builtins import super
+from collections import deque, OrderedDict
+
 from ethereum.slogging import get_logger
 from ethereum.pow.chain import Chain
 
 from sharding.shard_chain import ShardChain
+from sharding.collator import PeriodContext
 
 
 log = get_logger('eth.chain')
@@ -13,19 +16,78 @@ class MainChain(Chain):
     """
 
     def __init__(self, genesis=None, env=None,
-                 new_head_cb=None, reset_genesis=False, localtime=None, **kwargs):
+                 new_head_cb=None, reset_genesis=False, localtime=None, shard_executor=None, **kwargs):
+        self.child_hashes_cache = OrderedDict()   # blockhash -> list[blockhash], least recently used first
+        self.max_child_hashes_cache = 1024
+        self.period_contexts = OrderedDict()   # period number -> PeriodContext
+        self.max_period_contexts = 16
         super().__init__(
             genesis=genesis, env=env,
             new_head_cb=new_head_cb, reset_genesis=reset_genesis, localtime=localtime, **kwargs)
         self.shards = {}
         self.shard_id_list = set()
+        # The shards are run by the worker processes of shard_executor if it is given
+        self.shard_executor = shard_executor
+        # The orphan pools are expired when a block of a later period arrives
+        self.orphans_period_number = None
+
+    def add_block(self, block):
+        prev_head_hash = self.head_hash
+        result = super().add_block(block)
+        # The parent got a new child
+        self.child_hashes_cache.pop(block.header.prevhash, None)
+        # The period start blocks may have changed if the head was reorganized
+        if self.head_hash != prev_head_hash and block.header.prevhash != prev_head_hash:
+            self.period_contexts.clear()
+        return result
+
+    def get_period_context(self, period_number):
+        """Get the PeriodContext of a period, which is cached once its
+        period_start_prevblock exists
+        """
+        if period_number in self.period_contexts:
+            return self.period_contexts[period_number]
+        context = PeriodContext(self, period_number)
+        if context.period_start_prevblock is not None:
+            self.period_contexts[period_number] = context
+            while len(self.period_contexts) > self.max_period_contexts:
+                self.period_contexts.popitem(last=False)
+        return context
+
+    def get_period_start_prevblock(self, header):
+        """Get the period_start_prevblock of a collation header, or None
+        """
+        context = self.get_period_context(header.expected_period_number)
+        if context.period_start_prevhash == header.period_start_prevhash:
+            return context.period_start_prevblock
+        return self.get_block(header.period_start_prevhash)
+
+    def get_child_hashes(self, blockhash):
+        """Get the hashes of the known children of a block
+        (cached until a child block is added, or the least recently used
+        entries are evicted)
+        """
+        child_hashes = self.child_hashes_cache.pop(blockhash, None)
+        if child_hashes is None:
+            child_hashes = super().get_child_hashes(blockhash)
+        self.child_hashes_cache[blockhash] = child_hashes
+        while len(self.child_hashes_cache) > self.max_child_hashes_cache:
+            self.child_hashes_cache.popitem(last=False)
+        return child_hashes
 
-    def init_shard(self, shard_id):
+    def init_shard(self, shard_id, initial_state=None):
         """Initialize a new ShardChain and add it to MainChain
+
+        initial_state: the genesis state of the shard, an empty state if None
         """
         if not self.has_shard(shard_id):
             self.shard_id_list.add(shard_id)
-            self.shards[shard_id] = ShardChain(env=self.env, shard_id=shard_id)
+            if self.shard_executor is not None:
+                self.shard_executor.init_shard(shard_id, initial_state)
+            elif initial_state is not None:
+                self.shards[shard_id] = ShardChain(shard_id=shard_id, initial_state=initial_state)
+            else:
+                self.shards[shard_id] = ShardChain(env=self.env, shard_id=shard_id)
             return True
         else:
             return False
@@ -45,6 +107,61 @@ class MainChain(Chain):
         """
         return shard_id in self.shard_id_list
 
+    def add_collations(self, collations):
+        """Add collations of any tracked shards
+
+        The collations of the shards run by a ShardExecutor are applied in
+        parallel by its workers, the others are added to self.shards one
+        shard after another.
+
+        Return a list of whether each collation is added
+        """
+        period_start_prevblocks = [self.get_period_start_prevblock(c.header) for c in collations]
+        results = self.add_collations_to_shards(collations, period_start_prevblocks)
+        for index, collation in enumerate(collations):
+            if not results[index]:
+                continue
+            try:
+                self.handle_ignored_collation(collation)
+            except Exception as e:
+                log.info('handle_ignored_collation exception: {}'.format(str(e)))
+                results[index] = False
+        return results
+
+    def add_collations_to_shards(self, collations, period_start_prevblocks):
+        """Apply collations to their shards, without reading the main chain
+
+        The orphans of the added collations are left to handle_ignored_collation
+
+        Return a list of whether each collation is added, the collations of
+        the shards which are not tracked are not added
+        """
+        results = []
+        remote = []     # indexes of the collations of the shards of shard_executor
+        for index, (collation, period_start_prevblock) in enumerate(zip(collations, period_start_prevblocks)):
+            shard_id = collation.header.shard_id
+            if shard_id in self.shards:
+                results.append(self.shards[shard_id].add_collation(collation, period_start_prevblock))
+            else:
+                results.append(False)
+                if self.shard_executor is not None and self.shard_executor.has_shard(shard_id):
+                    remote.append(index)
+                else:
+                    log.info('Collation of untracked shard %d is ignored' % shard_id)
+        if remote:
+            verdicts = self.shard_executor.add_collations(
+                [collations[i] for i in remote], [period_start_prevblocks[i] for i in remote])
+            for index, added in zip(remote, verdicts):
+                results[index] = added
+        return results
+
+    def _call_shard(self, shard_id, method, *args):
+        """Call a method of a ShardChain, in its worker if the shard is run by shard_executor
+        """
+        if shard_id in self.shards:
+            return getattr(self.shards[shard_id], method)(*args)
+        return self.shard_executor.call(shard_id, method, *args)
+
     def get_expected_period_number(self):
         """Get default expected period number to be the period number of the next block
         """
@@ -53,31 +170,36 @@ class MainChain(Chain):
     def get_period_start_prevhash(self, expected_period_number):
         """Get period_start_prevhash by expected_period_number
         """
-        block_number = self.env.config['PERIOD_LENGTH'] * expected_period_number - 1
-        period_start_prevhash = self.get_blockhash_by_number(block_number)
+        period_start_prevhash = self.get_period_context(expected_period_number).period_start_prevhash
         if period_start_prevhash is None:
-            log.info('No such block number %d' % block_number)
+            log.info('No such block number %d' % (self.env.config['PERIOD_LENGTH'] * expected_period_number - 1))
 
         return period_start_prevhash
 
-    # TODO: test
     def update_head_collation_of_block(self, collation):
         """Update ShardChain.head_collation_of_block
+
+        If the given collation beats the current head collation, it becomes the
+        head collation of the blocks which include it and of their descendants
         """
         shard_id = collation.header.shard_id
         collhash = collation.header.hash
 
-        # Get the blockhash list of blocks that include the given collation
-        if collhash in self.shards[shard_id].collation_blockhash_lists:
-            blockhash_list = self.shards[shard_id].collation_blockhash_lists[collhash]
-            while blockhash_list:
-                blockhash = blockhash_list.pop(0)
-                given_collation_score = self.shards[shard_id].get_score(collation)
-                head_collation_score = self.shards[shard_id].get_score(self.shards[shard_id].head)
-                if given_collation_score > head_collation_score:
-                    self.shards[shard_id].head_collation_of_block[blockhash] = collhash
-                    block = self.get_block(blockhash)
-                    blockhash_list.extend(self.get_children(block))
+        # Get the blockhash list of blocks that include the given collation,
+        # if it beats the current head collation
+        queue = deque(self._call_shard(shard_id, 'get_blockhashes_of_better_collation', collhash))
+        if not queue:
+            return True
+
+        # Breadth-first walk over the descendants
+        visited = set(queue)
+        while queue:
+            blockhash = queue.popleft()
+            for child_hash in self.get_child_hashes(blockhash):
+                if child_hash not in visited:
+                    visited.add(child_hash)
+                    queue.append(child_hash)
+        self._call_shard(shard_id, 'set_head_collation_of_blocks', collhash, list(visited))
         return True
 
     # TODO: implement in pyethapp
@@ -96,54 +218,65 @@ class MainChain(Chain):
     def reorganize_head_collation(self, block, collation=None):
         """Reorganize head collation
         """
-        # Use alias for clear code
+        self._expire_orphans(block)
+
         blockhash = block.header.hash
-        if collation is None:
-            collhash = shard_id = shard = None
-        else:
-            collhash = collation.header.hash
-            shard_id = collation.header.shard_id
-            shard = self.shards[shard_id]
-
-        # Update collation_blockhash_lists
-        if self.has_shard(shard_id) and shard.db.get(collhash) is not None:
-            shard.collation_blockhash_lists[collhash].append(blockhash)
-            # Compare score
-            given_coll_score = shard.get_score(collation)
-            prev_head_coll_score = shard.get_head_coll_score(block.header.prevhash)
-            if given_coll_score > prev_head_coll_score:
-                shard.head_collation_of_block[blockhash] = collhash
-            else:
-                shard.head_collation_of_block[blockhash] = shard.head_collation_of_block[block.header.prevhash]
-            # Set head
-            shard.head_hash = shard.head_collation_of_block[self.head_hash]
-            shard.state = shard.mk_poststate_of_collation_hash(shard.head_hash)
-        else:
-            # The given block doesn't contain a collation
-            self._reorganize_all_shards(block)
+        prevhash = block.header.prevhash
+        if collation is not None and self.has_shard(collation.header.shard_id):
+            if self._call_shard(
+                    collation.header.shard_id, 'include_collation',
+                    collation.header.hash, blockhash, block.header.number, prevhash, self.head_hash):
+                return
+        # The given block doesn't contain a collation
+        self._reorganize_all_shards(block)
 
     def _reorganize_all_shards(self, block):
         """Reorganize all shards' head
         """
-        blockhash = block.header.hash
-        block_prevhash = block.header.prevhash
+        args = (block.header.hash, block.header.number, block.header.prevhash, self.head_hash)
         for k in self.shards:
-            if block_prevhash in self.shards[k].head_collation_of_block:
-                self.shards[k].head_collation_of_block[blockhash] = self.shards[k].head_collation_of_block[block_prevhash]
-                self.shards[k].head_hash = self.shards[k].head_collation_of_block[self.head_hash]
-            else:
-                # The shard was just initialized
-                self.shards[k].head_collation_of_block[blockhash] = self.shards[k].head_hash
-            self.shards[k].state = self.shards[k].mk_poststate_of_collation_hash(self.shards[k].head_hash)
+            self.shards[k].follow_block(*args)
+        if self.shard_executor is not None:
+            # The workers follow the block in parallel
+            self.shard_executor.call_shards(self._executor_shard_ids(), 'follow_block', *args)
+
+    def _expire_orphans(self, block):
+        """Drop the orphan collations which are too old to be included, once per period
+        """
+        if not self.shard_id_list:
+            return
+        period_number = block.header.number // self.env.config['PERIOD_LENGTH']
+        if self.orphans_period_number is not None and period_number <= self.orphans_period_number:
+            return
+        self.orphans_period_number = period_number
+        for k in self.shards:
+            self.shards[k].expire_orphans(period_number)
+        if self.shard_executor is not None:
+            self.shard_executor.call_shards(self._executor_shard_ids(), 'expire_orphans', period_number)
+
+    def _executor_shard_ids(self):
+        return [k for k in self.shard_id_list if k not in self.shards]
 
     def handle_ignored_collation(self, collation):
         """Handle the ignored collation (previously ignored collation)
 
         collation: the parent collation
+
+        The orphans waiting for the collation, and then the orphans waiting for
+        those, are applied in topological order with a work queue
         """
-        if collation.header.hash in self.shards[collation.shard_id].parent_queue:
-            for _collation in self.shards[collation.shard_id].parent_queue[collation.header.hash]:
-                _period_start_prevblock = self.get_block(collation.header.period_start_prevhash)
-                self.shards[collation.shard_id].add_collation(_collation, _period_start_prevblock, self.handle_ignored_collation)
-                del self.shards[collation.shard_id].parent_queue[collation.header.hash]
-        self.update_head_collation_of_block(collation)
+        shard_id = collation.header.shard_id
+        queue = deque([collation])
+        while queue:
+            parent = queue.popleft()
+            for _collation in self._pop_orphans(shard_id, parent.header.hash):
+                _period_start_prevblock = self.get_period_start_prevblock(_collation.header)
+                # The children of _collation are handled by this loop
+                if self.add_collations_to_shards([_collation], [_period_start_prevblock])[0]:
+                    queue.append(_collation)
+            self.update_head_collation_of_block(parent)
+
+    def _pop_orphans(self, shard_id, parent_collation_hash):
+        if shard_id in self.shards:
+            return self.shards[shard_id].parent_queue.pop(parent_collation_hash)
+        return self.shard_executor.pop_orphans(shard_id, parent_collation_hash)
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from collections import namedtuple
+
+from ethereum.slogging import get_logger
+
+from sharding.collator import verify_collation_header
+
+log = get_logger('sharding.node')
+log.setLevel(logging.DEBUG)
+
+# shard_id is None for the head of the main chain
+ReorgEvent = namedtuple('ReorgEvent', ['shard_id', 'old_head_hash', 'new_head_hash'])
+
+
+class ShardNode(object):
+    """asyncio runtime of a MainChain and its ShardChains
+
+    Blocks, collation headers and collation bodies are taken from their own
+    queues. Collation bodies are applied in `executor` (the default executor
+    of the loop if None) while holding the lock of their shard, so they
+    overlap with each other, with the import of blocks and with the
+    verification of headers, which share the lock of the main chain. With a
+    ShardExecutor in the chain, the bodies are applied in its worker
+    processes. The changes of head are published as ReorgEvents to the
+    queues returned by subscribe.
+
+    The queues and the locks are bound to the current event loop, which has
+    to be `loop`.
+    """
+
+    def __init__(self, chain, loop=None, executor=None):
+        self.chain = chain
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = executor
+        self.block_queue = asyncio.Queue()
+        self.header_queue = asyncio.Queue()
+        self.body_queue = asyncio.Queue()
+        self.main_lock = asyncio.Lock()
+        self.shard_locks = {}
+        self.subscribers = []
+        self.tasks = []
+        self.pending = set()
+
+    def subscribe(self):
+        """Return a queue which receives the ReorgEvents
+        """
+        queue = asyncio.Queue()
+        self.subscribers.append(queue)
+        return queue
+
+    def publish(self, event):
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+    def submit_block(self, block, collation=None):
+        """Queue a block, and the collation whose header it includes if any
+        """
+        self.block_queue.put_nowait((block, collation))
+
+    def submit_header(self, header, callback=None):
+        """Queue a collation header to verify, callback is called with the header and the result
+        """
+        self.header_queue.put_nowait((header, callback))
+
+    def submit_collation(self, collation):
+        self.body_queue.put_nowait(collation)
+
+    def start(self):
+        self.tasks = [
+            asyncio.ensure_future(self._consume(self.block_queue, self._import_block), loop=self.loop),
+            asyncio.ensure_future(self._consume(self.header_queue, self._verify_header), loop=self.loop),
+            asyncio.ensure_future(self._consume(self.body_queue, self._spawn_import_collation), loop=self.loop),
+        ]
+
+    def stop(self):
+        for task in self.tasks + list(self.pending):
+            task.cancel()
+        self.tasks = []
+
+    async def join(self):
+        """Wait until all the queued items are processed
+        """
+        for queue in (self.block_queue, self.header_queue, self.body_queue):
+            await queue.join()
+        while self.pending:
+            await asyncio.wait(list(self.pending))
+
+    async def _consume(self, queue, handler):
+        while True:
+            item = await queue.get()
+            try:
+                await handler(item)
+            except Exception as e:
+                log.info('Failed to handle %s, exception: %s' % (str(item), str(e)))
+            finally:
+                queue.task_done()
+
+    def _shard_lock(self, shard_id):
+        if shard_id not in self.shard_locks:
+            self.shard_locks[shard_id] = asyncio.Lock()
+        return self.shard_locks[shard_id]
+
+    def _run(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    async def _import_block(self, item):
+        block, collation = item
+        async with self.main_lock:
+            old_head_hash = self.chain.head_hash
+            if not self.chain.add_block(block):
+                return
+            # The shards are reorganized once none of them is importing a collation
+            shard_ids = sorted(self.chain.shards)
+            for shard_id in shard_ids:
+                await self._shard_lock(shard_id).acquire()
+            try:
+                old_heads = dict((k, self.chain.shards[k].head_hash) for k in shard_ids)
+                self.chain.reorganize_head_collation(block, collation)
+            finally:
+                for shard_id in shard_ids:
+                    self._shard_lock(shard_id).release()
+        if self.chain.head_hash != old_head_hash:
+            self.publish(ReorgEvent(None, old_head_hash, self.chain.head_hash))
+        for shard_id in shard_ids:
+            if self.chain.shards[shard_id].head_hash != old_heads[shard_id]:
+                self.publish(ReorgEvent(shard_id, old_heads[shard_id], self.chain.shards[shard_id].head_hash))
+
+    async def _verify_header(self, item):
+        header, callback = item
+        async with self.main_lock:
+            try:
+                result = await self._run(verify_collation_header, self.chain, header)
+            except ValueError as e:
+                log.info('Invalid collation header %s, reason: %s' % (header, str(e)))
+                result = False
+        if callback is not None:
+            callback(header, result)
+
+    async def _spawn_import_collation(self, collation):
+        # Collations of different shards are imported concurrently
+        task = asyncio.ensure_future(self._import_collation(collation), loop=self.loop)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _import_collation(self, collation):
+        shard_id = collation.header.shard_id
+        async with self.main_lock:
+            period_start_prevblock = self.chain.get_period_start_prevblock(collation.header)
+        # Only the shard is written in the executor
+        async with self._shard_lock(shard_id):
+            result = await self._run(self.chain.add_collations_to_shards, [collation], [period_start_prevblock])
+        if not result[0]:
+            return False
+        # The orphans and the head collations of the blocks need the main
+        # chain, the locks are taken in the order of _import_block
+        async with self.main_lock:
+            async with self._shard_lock(shard_id):
+                try:
+                    await self._run(self.chain.handle_ignored_collation, collation)
+                except Exception as e:
+                    log.info('handle_ignored_collation exception: {}'.format(str(e)))
+                    return False
+        return True
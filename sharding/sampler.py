@@ -0,0 +1,122 @@
+from collections import OrderedDict
+
+from sharding.validator_manager_view import (ValidatorManagerView, ZERO_ADDR,
+                                             get_index_in_subset, get_sampled_index)
+
+
+class CycleTable(object):
+    """The collators sampled in a shuffling cycle, from one read of the validator set
+
+    The table maps (shard_id, index_in_subset) to the validation code address
+    sample returns for them, the seed of a period only picks the
+    index_in_subset of each shard.
+
+    cycle_seed: the hash of the block before the start of the cycle
+    validation_code_addrs: the validation code addresses of the validators
+    in the order of their indexes
+    """
+
+    def __init__(self, cycle_seed, validation_code_addrs, num_validators_per_cycle, shard_count):
+        self.cycle_seed = cycle_seed
+        self.validation_code_addrs = validation_code_addrs
+        self.num_validators_per_cycle = num_validators_per_cycle
+        self.shard_count = shard_count
+        self.table = {}
+        # validation_code_addr -> {shard_id: set of index_in_subset}
+        self.eligibility = None
+
+    def get(self, shard_id, index_in_subset):
+        key = (shard_id, index_in_subset)
+        if key not in self.table:
+            self.table[key] = self._sample(shard_id, index_in_subset)
+        return self.table[key]
+
+    def _sample(self, shard_id, index_in_subset):
+        num_validators = len(self.validation_code_addrs)
+        if num_validators == 0:
+            return ZERO_ADDR
+        return self.validation_code_addrs[
+            get_sampled_index(self.cycle_seed, shard_id, index_in_subset, num_validators)]
+
+    def fill(self):
+        """Sample every (shard_id, index_in_subset) of the cycle
+        """
+        if self.eligibility is None:
+            self.eligibility = {}
+            for shard_id in range(self.shard_count):
+                for index_in_subset in range(self.num_validators_per_cycle):
+                    addr = self.get(shard_id, index_in_subset)
+                    indexes = self.eligibility.setdefault(addr, {}).setdefault(shard_id, set())
+                    indexes.add(index_in_subset)
+        return self.eligibility
+
+    def sample(self, period_seed, shard_id):
+        return self.get(shard_id, get_index_in_subset(period_seed, shard_id, self.num_validators_per_cycle))
+
+    def get_schedule(self, validation_code_addr, period_seeds):
+        """The sorted (period_number, shard_id) in which the validator is sampled
+
+        period_seeds: dict of period_number -> the seed of the period
+        """
+        shards = self.fill().get(validation_code_addr, {})
+        schedule = []
+        # Only the index_in_subset of the shards the validator can be sampled in are hashed
+        for period_number, period_seed in period_seeds.items():
+            for shard_id, indexes in shards.items():
+                if get_index_in_subset(period_seed, shard_id, self.num_validators_per_cycle) in indexes:
+                    schedule.append((period_number, shard_id))
+        return sorted(schedule)
+
+
+class Sampler(object):
+    """Off-chain sample of the validator manager contract
+
+    The validator set is read from the storage of the contract once per
+    cycle seed, and read again after every deposit or withdrawal, which
+    increment the registry nonce of the contract.
+    """
+
+    def __init__(self, address=None, max_tables=4):
+        self.address = address
+        self.max_tables = max_tables
+        self.tables = OrderedDict()
+
+    def get_table(self, state):
+        view = ValidatorManagerView(state, self.address)
+        key = (view.get_cycle_seed(), view.registry_nonce)
+        if key in self.tables:
+            return self.tables[key]
+        cycle_seed = key[0]
+        validation_code_addrs = [view.get_validation_code_addr(i) for i in range(view.num_validators)]
+        table = CycleTable(cycle_seed, validation_code_addrs, view.num_validators_per_cycle, view.shard_count)
+        self.tables[key] = table
+        while len(self.tables) > self.max_tables:
+            self.tables.popitem(last=False)
+        return table
+
+    def sample(self, state, shard_id):
+        """The validation code address sample(shard_id) of the contract returns in state
+        """
+        view = ValidatorManagerView(state, self.address)
+        if state.block_number < view.period_length:
+            raise ValueError('Sampling before the first period')
+        return self.get_table(state).sample(view.get_period_seed(), shard_id)
+
+    def get_schedule(self, state, validation_code_addr, period_numbers=None):
+        """The sorted (period_number, shard_id) in which the validator is sampled
+
+        The seeds of the periods have to be known in state, by default the
+        schedule of the current period is returned. The validator set and
+        the cycle seed of state are used for all the periods.
+        """
+        view = ValidatorManagerView(state, self.address)
+        current_period_number = state.block_number // view.period_length
+        if period_numbers is None:
+            period_numbers = [current_period_number]
+        period_seeds = {}
+        for period_number in period_numbers:
+            if not 0 < period_number <= current_period_number or \
+                    state.block_number - (period_number * view.period_length - 1) > 256:
+                raise ValueError('The seed of period %d is not known' % period_number)
+            period_seeds[period_number] = view.get_period_seed(period_number)
+        return self.get_table(state).get_schedule(validation_code_addr, period_seeds)
@@ -1,57 +1,337 @@
+import copy
 import time
 import json
 import logging
-from collections import defaultdict
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import rlp
 from rlp.utils import encode_hex
 
 from ethereum.exceptions import InvalidTransaction, VerificationFailed
 from ethereum.slogging import get_logger
+from ethereum.utils import str_to_bytes
 from ethereum.config import Env
-from ethereum.state import State
+from ethereum.state import State, STATE_DEFAULTS
+from ethereum.db import RefcountDB
 from ethereum.pow.consensus import initialize
 
 from sharding.collation import CollationHeader, Collation
 from sharding.collator import apply_collation
+from sharding.db import WriteBatch
 from sharding.state_transition import update_collation_env_variables
 
 log = get_logger('sharding.shard_chain')
 log.setLevel(logging.DEBUG)
 
 
-def initialize_genesis_keys(state, genesis):
+def initialize_genesis_keys(state, genesis, db=None):
     """Rewrite ethereum.genesis_helpers.initialize_genesis_keys
+
+    db: a WriteBatch to put the keys in, the keys are committed to the state
+    db right away if it is None
     """
-    db = state.db
+    batch = db
+    db = state.db if batch is None else batch
     # db.put('GENESIS_NUMBER', str(genesis.header.number))
     db.put('GENESIS_HASH', str(genesis.header.hash))
-    db.put('GENESIS_STATE', json.dumps(state.to_snapshot()))
+    # The trie nodes are in db after commit, so only the state root is kept
+    state.commit()
+    db.put('GENESIS_STATE', json.dumps(state.to_snapshot(root_only=True)))
     db.put('GENESIS_RLP', rlp.encode(genesis))
     db.put(b'score:' + genesis.header.hash, "0")
     db.put(b'state:' + genesis.header.hash, state.trie.root_hash)
     db.put(genesis.header.hash, 'GENESIS')
-    db.commit()
+    if batch is None:
+        db.commit()
+
+
+def clone_state(state, env=None):
+    """Copy a committed state onto the same env, or onto the given env
+    (refer to ethereum.state.State.ephemeral_clone)
+
+    Unlike ephemeral_clone, the trie of the copy still writes to the env db,
+    so the copy can be used to apply and store new collations.
+    """
+    state.commit()
+    s = State(state.trie.root_hash, env or state.env)
+    for param in STATE_DEFAULTS:
+        setattr(s, param, copy.copy(getattr(state, param)))
+    s.recent_uncles = state.recent_uncles
+    s.prev_headers = state.prev_headers
+    return s
+
+
+class PostStateCache(object):
+    """LRU cache of collation post-states keyed by collation hash
+
+    Only committed states without account cache and journal are kept, so
+    every entry has a small fixed size and `max_size` bounds the memory.
+    `get` hands out a fresh copy on every hit.
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.states = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, collation_hash):
+        return collation_hash in self.states
+
+    def __len__(self):
+        return len(self.states)
+
+    def get(self, collation_hash, env=None):
+        """Return a copy of the cached post-state, or None
+        """
+        state = self.states.pop(collation_hash, None)
+        if state is None:
+            self.misses += 1
+            return None
+        # Move to the most recently used end
+        self.states[collation_hash] = state
+        self.hits += 1
+        return clone_state(state, env)
+
+    def put(self, collation_hash, state):
+        """Cache a copy of the given post-state
+        """
+        if self.max_size <= 0:
+            return
+        self.states.pop(collation_hash, None)
+        self.states[collation_hash] = clone_state(state)
+        while len(self.states) > self.max_size:
+            self.states.popitem(last=False)
+
+    def discard(self, collation_hash):
+        self.states.pop(collation_hash, None)
+
+
+class OrphanPool(object):
+    """Collations whose parent collation is not known yet, grouped by parent hash
+
+    The pool keeps at most `max_size` collations and evicts the oldest
+    arrivals first. Collations expected more than `max_periods` periods
+    before the current period are expired.
+    """
+
+    def __init__(self, max_size=1024, max_periods=10):
+        self.max_size = max_size
+        self.max_periods = max_periods
+        self.collations = OrderedDict()     # collation hash -> collation, in arrival order
+        self.children = {}                  # parent collation hash -> list[collation hash]
+        self.added = 0
+        self.duplicates = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def __contains__(self, parent_collation_hash):
+        return parent_collation_hash in self.children
+
+    def __len__(self):
+        return len(self.collations)
+
+    def __getitem__(self, parent_collation_hash):
+        return [self.collations[h] for h in self.children[parent_collation_hash]]
+
+    def add(self, collation):
+        """Add an orphan collation, return False if it is already in the pool
+        """
+        collhash = collation.header.hash
+        if collhash in self.collations:
+            self.duplicates += 1
+            return False
+        while self.collations and len(self.collations) >= self.max_size:
+            self._remove(next(iter(self.collations)))
+            self.evicted += 1
+        self.collations[collhash] = collation
+        self.children.setdefault(collation.header.parent_collation_hash, []).append(collhash)
+        self.added += 1
+        return True
+
+    def pop(self, parent_collation_hash):
+        """Remove and return the orphans of the given parent
+        """
+        return [self.collations.pop(h) for h in self.children.pop(parent_collation_hash, [])]
+
+    def expire(self, period_number):
+        """Remove the orphans which are too old to be included in period_number
+        """
+        for collhash, collation in list(self.collations.items()):
+            if collation.header.expected_period_number + self.max_periods < period_number:
+                self._remove(collhash)
+                self.expired += 1
+
+    def _remove(self, collhash):
+        collation = self.collations.pop(collhash)
+        parent_collation_hash = collation.header.parent_collation_hash
+        self.children[parent_collation_hash].remove(collhash)
+        if not self.children[parent_collation_hash]:
+            del self.children[parent_collation_hash]
+
+
+class DBIndex(object):
+    """A dict of hashes persisted in the db of a shard chain under a key prefix
+
+    Entries are read from db on first access, so nothing is loaded when the
+    chain starts, and every write is put in db to be committed with it.
+    At most `max_size` recently used entries are kept in memory, the older
+    ones are evicted and read from db again if needed.
+    """
+
+    def __init__(self, chain, prefix, max_size=2048):
+        self.chain = chain
+        self.prefix = prefix
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.evicted = 0
+
+    def __contains__(self, key):
+        return key in self.cache or self.prefix + key in self.chain.db
+
+    def __getitem__(self, key):
+        value = self.cache.pop(key, None)
+        if value is None:
+            value = self.decode(self.chain.db.get(self.prefix + key))
+            self._cache(key, value)
+        else:
+            # Move to the most recently used end
+            self.cache[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._uncache(key)
+        self._cache(key, value)
+        self.chain.db.put(self.prefix + key, self.encode(value))
+
+    def __delitem__(self, key):
+        self._uncache(key)
+        self.chain.db.delete(self.prefix + key)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def _cache(self, key, value):
+        self.cache[key] = value
+        while len(self.cache) > self.max_size:
+            self._uncache(next(iter(self.cache)))
+            self.evicted += 1
+
+    def _uncache(self, key):
+        self.cache.pop(key, None)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def encode(self, value):
+        return value
+
+    def decode(self, data):
+        return data
+
+
+class DBListIndex(DBIndex):
+    """A DBIndex of lists of hashes
+    """
+
+    def __getitem__(self, key):
+        return list(super(DBListIndex, self).__getitem__(key))
+
+    def append(self, key, value):
+        """Append a hash to the list of a key, which starts empty
+        """
+        values = self[key] if key in self else []
+        values.append(value)
+        self[key] = values
+
+    def encode(self, value):
+        return b''.join(value)
+
+    def decode(self, data):
+        return [data[i: i + 32] for i in range(0, len(data), 32)]
+
+
+class HeadCollationIndex(DBIndex):
+    """The DBIndex of blockhash -> head collation hash
+
+    Consecutive blocks mostly share their head collation, so the cached
+    collation hashes are interned and counted, and each one is kept in memory
+    once however many blocks point to it.
+    """
+
+    def __init__(self, chain, prefix, max_size=2048):
+        super(HeadCollationIndex, self).__init__(chain, prefix, max_size)
+        self.collation_hashes = {}  # collation hash -> (interned collation hash, number of blocks)
+
+    def _cache(self, key, value):
+        interned, count = self.collation_hashes.get(value, (value, 0))
+        self.collation_hashes[value] = (interned, count + 1)
+        super(HeadCollationIndex, self)._cache(key, interned)
+
+    def _uncache(self, key):
+        value = self.cache.pop(key, None)
+        if value is None:
+            return
+        interned, count = self.collation_hashes[value]
+        if count == 1:
+            del self.collation_hashes[value]
+        else:
+            self.collation_hashes[value] = (interned, count - 1)
+
+
+def delete_trie_nodes(db, deletes):
+    """Decrease the refcounts of the trie nodes in a `deletes:` journal
+    and return the number of bytes actually deleted from db
+    """
+    rdb = RefcountDB(db)
+    reclaimed = 0
+    for i in range(0, len(deletes), 32):
+        key = deletes[i: i + 32]
+        try:
+            if rdb.get_refcount(key) == 1:
+                reclaimed += len(db.get(key))
+            rdb.delete(key)
+        except KeyError:
+            pass
+    return reclaimed
 
 
 class ShardChain(object):
     def __init__(self, shard_id, env=None,
                  new_head_cb=None, reset_genesis=False, localtime=None, max_history=1000,
-                 initial_state=None, **kwargs):
+                 initial_state=None, post_state_cache_size=64, prune_interval=100,
+                 max_orphans=1024, orphan_max_periods=10, fork_choice_cache_size=2048,
+                 fork_choice_history=1000, **kwargs):
         self.env = env or Env()
         self.shard_id = shard_id
-
-        self.collation_blockhash_lists = defaultdict(list)    # M1: collation_header_hash -> list[blockhash]
-        self.head_collation_of_block = {}   # M2: blockhash -> head_collation
+        self._batch = None
+        self._batch_env = None
+        self.post_state_cache = PostStateCache(post_state_cache_size)
+        self._genesis_state = None
+
+        # The fork choice indexes are kept in db and read back lazily after a restart
+        self.collation_blockhash_lists = DBListIndex(             # M1: collation_header_hash -> list[blockhash]
+            self, str_to_bytes('shard_%d_collation_blockhash_list:' % shard_id), fork_choice_cache_size)
+        self.head_collation_of_block = HeadCollationIndex(        # M2: blockhash -> head_collation
+            self, str_to_bytes('shard_%d_head_collation_of_block:' % shard_id), fork_choice_cache_size)
+        # The blocks of head_collation_of_block by block number, the entries of
+        # the blocks more than fork_choice_history blocks old are deleted
+        self.head_collation_blocks = DBListIndex(                 # block number -> list[blockhash]
+            self, str_to_bytes('shard_%d_head_collation_blocks:' % shard_id), fork_choice_cache_size)
+        self.fork_choice_history = fork_choice_history
 
         # Initialize the state
-        head_hash_key = 'shard_' + str(shard_id) + '_head_hash'
+        head_hash_key = self.head_hash_key
         if head_hash_key in self.db:  # new head tag
-            self.state = self.mk_poststate_of_collation_hash(self.db.get(head_hash_key))
+            self.head_hash = self.db.get(head_hash_key)
+            self.state = self.mk_poststate_of_collation_hash(self.head_hash)
             log.info(
-                'Initializing shard chain from saved head, #%d (%s)' %
-                (self.state.prev_headers[0].number, encode_hex(self.state.prev_headers[0].hash)))
-            self.head_hash = self.state.prev_headers[0].hash
+                'Initializing shard chain from saved head, score %d (%s)' %
+                (self.get_score_of_collation_hash(self.head_hash), encode_hex(self.head_hash)))
+            # Migrate databases written before the score index was kept by add_collation
+            with self.write_batch():
+                self.backfill_score(self.head_hash)
         else:
             # no head_hash in db -> empty shard chain
             if initial_state is not None and isinstance(initial_state, State):
@@ -65,13 +345,6 @@ class ShardChain(object):
                 self.last_state = self.state.to_snapshot()
 
             self.head_hash = self.env.config['GENESIS_PREVHASH']
-            self.db.put(self.head_hash, 'GENESIS')
-            self.db.put(head_hash_key, self.head_hash)
-
-            # initial score
-            key = b'score:' + self.head_hash
-            self.db.put(key, str(0))
-            self.db.commit()
             reset_genesis = True
 
         assert self.env.db == self.state.db
@@ -80,17 +353,79 @@ class ShardChain(object):
         self.new_head_cb = new_head_cb
 
         if reset_genesis:
-            initialize_genesis_keys(self.state, Collation(CollationHeader()))
+            with self.write_batch() as batch:
+                if head_hash_key not in batch:
+                    batch.put(self.head_hash, 'GENESIS')
+                    batch.put(head_hash_key, self.head_hash)
+                    # initial score
+                    batch.put(b'score:' + self.head_hash, str(0))
+                initialize_genesis_keys(self.state, Collation(CollationHeader()), batch)
 
         self.time_queue = []
-        self.parent_queue = {}
+        self.parent_queue = OrphanPool(max_orphans, orphan_max_periods)
         self.localtime = time.time() if localtime is None else localtime
         self.max_history = max_history
 
+        # Pruning of the collations below the history window
+        self.prune_interval = prune_interval
+        self.pruned_collations = 0
+        self.pruned_bytes = 0
+
+        # Load the genesis state once, after GENESIS_STATE is written
+        self._genesis_state = self._load_genesis_state()
+
     @property
     def db(self):
+        """The open WriteBatch if any, otherwise the env db
+        """
+        if self._batch is not None:
+            return self._batch
         return self.env.db
 
+    @contextmanager
+    def write_batch(self):
+        """Buffer all the writes to db and commit them once on exit
+
+        The states made inside the block write their trie nodes to the batch
+        as well. A nested write_batch joins the open batch. Nothing is written
+        to db if the block raises.
+        """
+        if self._batch is not None:
+            yield self._batch
+            return
+        self._batch = WriteBatch(self.env.db)
+        self._batch_env = Env(self._batch, self.env.config, self.env.global_config)
+        try:
+            yield self._batch
+            self._batch.commit()
+        finally:
+            self._batch = None
+            self._batch_env = None
+
+    @property
+    def state_env(self):
+        """The env of the states to apply collations on
+        """
+        if self._batch_env is not None:
+            return self._batch_env
+        return self.env
+
+    @property
+    def head_hash_key(self):
+        return 'shard_' + str(self.shard_id) + '_head_hash'
+
+    @property
+    def genesis_state(self):
+        """The post-state of the genesis collation
+        """
+        if self._genesis_state is None:
+            self._genesis_state = self._load_genesis_state()
+        return self._genesis_state
+
+    def _load_genesis_state(self):
+        # Older databases store the full alloc, newer ones only the state root
+        return State.from_snapshot(json.loads(self.db.get('GENESIS_STATE')), self.env)
+
     # TODO: use head_collation_of_block to update head collation
     @property
     def head(self):
@@ -109,90 +444,257 @@ class ShardChain(object):
             log.info(str(e))
             return None
 
-    def add_collation(self, collation, period_start_prevblock, handle_ignored_collation):
+    def update_head(self, head_hash):
+        """Set the head collation, the head state is rebuilt only if the head changed
+        """
+        if head_hash == self.head_hash:
+            return False
+        self.head_hash = head_hash
+        self.db.put(self.head_hash_key, head_hash)
+        self.state = self.mk_poststate_of_collation_hash(head_hash)
+        if self.get_score_of_collation_hash(head_hash) - self.max_history - self.pruned_score >= self.prune_interval:
+            self.prune()
+        return True
+
+    @property
+    def pruned_score(self):
+        """The collations with scores up to pruned_score have been pruned
+        """
+        key = 'shard_' + str(self.shard_id) + '_pruned_score'
+        return int(self.db.get(key)) if key in self.db else 0
+
+    def get_collation_hashes_by_score(self, score):
+        """Get the hashes of all known collations with a given score
+        """
+        key = self._score_collations_key(score)
+        data = self.db.get(key) if key in self.db else b''
+        return [data[i: i + 32] for i in range(0, len(data), 32)]
+
+    def _score_collations_key(self, score):
+        return 'shard_' + str(self.shard_id) + '_score_' + str(score) + '_collations'
+
+    def prune(self):
+        """Delete the junk data of the collations which fall out of the
+        history window of the head collation
+
+        For the canonical collation of a pruned score, the trie nodes in its
+        `deletes:` journal and its journals are deleted. The collations which
+        lost fork choice are deleted altogether.
+        """
+        head_score = self.get_score_of_collation_hash(self.head_hash)
+        pruned_score = self.pruned_score
+        boundary = head_score - self.max_history
+        if boundary <= pruned_score:
+            return 0
+
+        # Find the canonical collations of the scores to prune
+        canonical = {}
+        collation_hash = self.head_hash
+        score = head_score
+        while score > pruned_score and collation_hash != self.env.config['GENESIS_PREVHASH']:
+            if score <= boundary:
+                canonical[score] = collation_hash
+            collation_hash = self.get_collation_header(collation_hash).parent_collation_hash
+            score -= 1
+
+        with self.write_batch():
+            reclaimed, pruned_collations = self._prune_scores(pruned_score, boundary, canonical)
+
+        self.pruned_collations += pruned_collations
+        self.pruned_bytes += reclaimed
+        log.info('Pruned shard %d up to score %d, deleted %d collations and %d bytes' %
+                 (self.shard_id, boundary, pruned_collations, reclaimed))
+        return reclaimed
+
+    def _prune_scores(self, pruned_score, boundary, canonical):
+        reclaimed = 0
+        pruned_collations = 0
+        for score in range(pruned_score + 1, boundary + 1):
+            collation_hashes = self.get_collation_hashes_by_score(score)
+            for collation_hash in collation_hashes:
+                if collation_hash == canonical.get(score):
+                    if b'deletes:' + collation_hash in self.db:
+                        reclaimed += delete_trie_nodes(self.db, self.db.get(b'deletes:' + collation_hash))
+                    # The parent post-state is no longer complete
+                    self.post_state_cache.discard(self.get_collation_header(collation_hash).parent_collation_hash)
+                else:
+                    reclaimed += len(self.db.get(collation_hash))
+                    self.db.delete(collation_hash)
+                    self.db.delete(b'score:' + collation_hash)
+                    self.post_state_cache.discard(collation_hash)
+                    pruned_collations += 1
+                for key in (b'deletes:' + collation_hash, b'changed:' + collation_hash):
+                    if key in self.db:
+                        reclaimed += len(self.db.get(key))
+                        self.db.delete(key)
+            if collation_hashes:
+                self.db.delete(self._score_collations_key(score))
+        self.db.put('shard_' + str(self.shard_id) + '_pruned_score', str(boundary))
+        return reclaimed, pruned_collations
+
+    def add_collation(self, collation, period_start_prevblock, handle_ignored_collation=None):
         """Add collation to db and update score
+
+        handle_ignored_collation: called with the added collation to apply its
+        orphan children, or None if the caller applies them itself
+        """
+        return self.add_collations([collation], [period_start_prevblock], handle_ignored_collation)[0]
+
+    def add_collations(self, collations, period_start_prevblocks, handle_ignored_collation=None):
+        """Add a list of collations in order and update scores
+
+        A collation whose parent is the previous collation in the list is
+        applied on the state left by the previous one, and all collations and
+        their trie nodes are written to db with one commit of a WriteBatch.
+
+        collations: the collations, parents first
+        period_start_prevblocks: the period_start_prevblock of each collation
+        handle_ignored_collation: called with each added collation to apply its
+        orphan children, or None if the caller applies them itself
+
+        Return a list of whether each collation is added
         """
-        if collation.header.parent_collation_hash in self.env.db:
+        results = []
+        added = []
+        with self.write_batch():
+            self._apply_collations(collations, period_start_prevblocks, results, added)
+
+        if not added:
+            return results
+
+        for _, collation in added:
             log.info(
-                'Receiving collation(%s) which its parent is in db: %s' %
-                (encode_hex(collation.header.hash), encode_hex(collation.header.parent_collation_hash)))
-            if self.is_first_collation(collation):
-                log.debug('It is the first collation of shard {}'.format(self.shard_id))
-            temp_state = self.mk_poststate_of_collation_hash(collation.header.parent_collation_hash)
+                'Added collation (%s) with %d txs' %
+                (encode_hex(collation.header.hash)[:8],
+                    len(collation.transactions)))
+
+            # Call optional callback
+            if self.new_head_cb and self.is_first_collation(collation):
+                self.new_head_cb(collation)
+
+        # The children applied next start from this post-state, which is only
+        # cached once its trie nodes are committed
+        if self._batch is None:
+            last = added[-1][1]
+            self.post_state_cache.put(
+                last.header.hash,
+                self._build_poststate(last.header, len(last.transactions)))
+
+        # TODO: It seems weird to use callback function to access member of MainChain
+        if handle_ignored_collation is not None:
+            for index, collation in added:
+                try:
+                    handle_ignored_collation(collation)
+                except Exception as e:
+                    log.info('handle_ignored_collation exception: {}'.format(str(e)))
+                    results[index] = False
+
+        return results
+
+    def _apply_collations(self, collations, period_start_prevblocks, results, added):
+        """Apply the collations of add_collations and put them in the open batch
+        """
+        applied = {}    # collation hash -> (header, transaction count, score)
+        state = None    # post-state of the previous collation in the list
+        prev_hash = None
+        for index, (collation, period_start_prevblock) in enumerate(zip(collations, period_start_prevblocks)):
+            parent_hash = collation.header.parent_collation_hash
+            if state is not None and parent_hash == prev_hash:
+                # Continue with the state of the previous collation
+                header, transaction_count, parent_score = applied[parent_hash]
+                self._reset_poststate(state, header, transaction_count)
+            elif parent_hash in applied:
+                header, transaction_count, parent_score = applied[parent_hash]
+                state = self._build_poststate(header, transaction_count)
+            elif parent_hash in self.db:
+                log.info(
+                    'Receiving collation(%s) which its parent is in db: %s' %
+                    (encode_hex(collation.header.hash), encode_hex(parent_hash)))
+                if self.is_first_collation(collation):
+                    log.debug('It is the first collation of shard {}'.format(self.shard_id))
+                state = self.mk_poststate_of_collation_hash(parent_hash)
+                parent_score = self.get_score_of_collation_hash(parent_hash)
+            else:
+                # Collation has no parent yet
+                log.info(
+                    'Receiving collation(%s) which its parent is NOT in db: %s' %
+                    (encode_hex(collation.header.hash), encode_hex(parent_hash)))
+                self.parent_queue.add(collation)
+                log.info('No parent found. Delaying for now')
+                results.append(False)
+                continue
+
             try:
-                apply_collation(temp_state, collation, period_start_prevblock)
+                apply_collation(state, collation, period_start_prevblock)
             except (AssertionError, KeyError, ValueError, InvalidTransaction, VerificationFailed) as e:
                 log.info('Collation %s with parent %s invalid, reason: %s' %
-                         (encode_hex(collation.header.hash), encode_hex(collation.header.parent_collation_hash), str(e)))
-                return False
-            deletes = temp_state.deletes
-            changed = temp_state.changed
-            collation_score = self.get_score(collation)
+                         (encode_hex(collation.header.hash), encode_hex(parent_hash), str(e)))
+                results.append(False)
+                state = prev_hash = None
+                continue
+            collation_score = parent_score + 1
             log.info('collation_score of {} is {}'.format(encode_hex(collation.header.hash), collation_score))
-        # Collation has no parent yet
-        else:
-            changed = []
-            deletes = []
-            log.info(
-                'Receiving collation(%s) which its parent is NOT in db: %s' %
-                (encode_hex(collation.header.hash), encode_hex(collation.header.parent_collation_hash)))
-            if collation.header.parent_collation_hash not in self.parent_queue:
-                self.parent_queue[collation.header.parent_collation_hash] = []
-            self.parent_queue[collation.header.parent_collation_hash].append(collation)
-            log.info('No parent found. Delaying for now')
-            return False
-        self.db.put(collation.header.hash, rlp.encode(collation))
-
-        self.db.put(b'changed:'+collation.hash, b''.join(list(changed.keys())))
-        # log.debug('Saved %d address change logs' % len(changed.keys()))
-        self.db.put(b'deletes:'+collation.hash, b''.join(deletes))
-        # log.debug('Saved %d trie node deletes for collation (%s)' % (len(deletes), encode_hex(collation.hash)))
 
-        # TODO: Delete old junk data
-        # deletes, changed
-
-        self.db.commit()
-        log.info(
-            'Added collation (%s) with %d txs' %
-            (encode_hex(collation.header.hash)[:8],
-                len(collation.transactions)))
+            self.db.put_collation(collation.header.hash, rlp.encode(collation))
+            self.db.put(b'score:' + collation.header.hash, str(collation_score))
+            score_collation_hashes = self.get_collation_hashes_by_score(collation_score)
+            if collation.header.hash not in score_collation_hashes:
+                score_collation_hashes.append(collation.header.hash)
+                self.db.put(self._score_collations_key(collation_score), b''.join(score_collation_hashes))
 
-        # Call optional callback
-        if self.new_head_cb and self.is_first_collation(collation):
-            self.new_head_cb(collation)
+            self.db.put(b'changed:'+collation.hash, b''.join(list(state.changed.keys())))
+            # log.debug('Saved %d address change logs' % len(changed.keys()))
+            self.db.put(b'deletes:'+collation.hash, b''.join(state.deletes))
+            # log.debug('Saved %d trie node deletes for collation (%s)' % (len(deletes), encode_hex(collation.hash)))
+            # The journals of the next collation start empty
+            state.changed = {}
+            state.deletes = []
 
-        # TODO: It seems weird to use callback function to access member of MainChain
-        try:
-            handle_ignored_collation(collation)
-        except Exception as e:
-            log.info('handle_ignored_collation exception: {}'.format(str(e)))
-            return False
+            applied[collation.header.hash] = (collation.header, len(collation.transactions), collation_score)
+            prev_hash = collation.header.hash
+            added.append((index, collation))
+            results.append(True)
 
-        return True
+        # Old junk data is deleted by prune() when the head moves
 
     def mk_poststate_of_collation_hash(self, collation_hash):
         """Return the post-state of the collation
         """
+        state = self.post_state_cache.get(collation_hash, self.state_env)
+        if state is not None:
+            return state
+
         if collation_hash not in self.db:
             raise Exception("Collation hash %s not found" % encode_hex(collation_hash))
 
         collation_rlp = self.db.get(collation_hash)
         if collation_rlp == 'GENESIS':
-            return State.from_snapshot(json.loads(self.db.get('GENESIS_STATE')), self.env)
-        collation = rlp.decode(collation_rlp, Collation)
+            state = clone_state(self.genesis_state, self.state_env)
+        else:
+            # Only decode the header, the transactions are just counted
+            lazy_collation = rlp.decode_lazy(collation_rlp)
+            header = CollationHeader.deserialize(lazy_collation[0])
+            state = self._build_poststate(header, len(lazy_collation[1]))
+        # The states on a WriteBatch may read uncommitted trie nodes
+        if self._batch is None:
+            self.post_state_cache.put(collation_hash, state)
+        return state
 
-        state = State(env=self.env)
-        state.trie.root_hash = collation.header.post_state_root
+    def _build_poststate(self, header, transaction_count):
+        state = State(env=self.state_env)
+        state.trie.root_hash = header.post_state_root
+        self._reset_poststate(state, header, transaction_count)
+
+        assert len(state.journal) == 0, state.journal
+        return state
 
-        update_collation_env_variables(state, collation)
+    def _reset_poststate(self, state, header, transaction_count):
+        update_collation_env_variables(state, Collation(header))
         state.gas_used = 0
-        state.txindex = len(collation.transactions)
+        state.txindex = transaction_count
         state.recent_uncles = {}
         state.prev_headers = []
 
-        assert len(state.journal) == 0, state.journal
-        return state
-
     def get_parent(self, collation):
         """Get the parent collation of a given collation
         """
@@ -216,41 +718,150 @@ class ShardChain(object):
             log.debug("Failed to get collation", hash=encode_hex(collation_hash), error=str(e))
             return None
 
+    def get_collation_header(self, collation_hash):
+        """Get the collation header with a given collation hash
+        without decoding the transactions of the collation
+        """
+        try:
+            collation_rlp = self.db.get(collation_hash)
+            if collation_rlp == 'GENESIS':
+                return CollationHeader()
+            else:
+                return CollationHeader.deserialize(rlp.decode_lazy(collation_rlp)[0])
+        except Exception as e:
+            log.debug("Failed to get collation header", hash=encode_hex(collation_hash), error=str(e))
+            return None
+
     def get_score(self, collation):
         """Get the score of a given collation
         """
-        score = 0
-
         if not collation:
             return 0
-        key = b'score:' + collation.header.hash
+        if collation.header.hash not in self.db:
+            # The collation is not added yet, it would extend its parent
+            return self.get_score_of_collation_hash(collation.header.parent_collation_hash) + 1
+        return self.get_score_of_collation_hash(collation.header.hash)
 
-        fills = []
+    def get_score_of_collation_hash(self, collation_hash):
+        """Get the score of the collation with a given collation hash
+        """
+        key = b'score:' + collation_hash
+        if key in self.db:
+            return int(self.db.get(key))
+        return self.backfill_score(collation_hash)
 
-        while key not in self.db and collation is not None:
-            fills.insert(0, collation.header.hash)
-            key = b'score:' + collation.header.parent_collation_hash
-            collation = self.get_parent(collation)
+    def backfill_score(self, collation_hash):
+        """Write the missing scores of a collation and its ancestors
 
-        score = int(self.db.get(key))
-        log.debug('int(self.db.get(key)):{}'.format(int(self.db.get(key))))
+        Scores are written by add_collation, this walks the parents of a
+        collation from an older database once until a known score is found.
+        """
+        fills = []
+        key = b'score:' + collation_hash
+        while key not in self.db:
+            header = self.get_collation_header(collation_hash)
+            if header is None:
+                break
+            fills.append(collation_hash)
+            collation_hash = header.parent_collation_hash
+            key = b'score:' + collation_hash
 
-        for h in fills:
-            key = b'score:' + h
+        score = int(self.db.get(key))
+        for h in reversed(fills):
             score += 1
-            self.db.put(key, str(score))
-
+            self.db.put(b'score:' + h, str(score))
         return score
 
     def get_head_coll_score(self, blockhash):
         if blockhash in self.head_collation_of_block:
             prev_head_coll_hash = self.head_collation_of_block[blockhash]
-            prev_head_coll = self.get_collation(prev_head_coll_hash)
-            prev_head_coll_score = self.get_score(prev_head_coll)
+            prev_head_coll_score = self.get_score_of_collation_hash(prev_head_coll_hash)
         else:
             prev_head_coll_score = 0
         return prev_head_coll_score
 
+    def expire_orphans(self, period_number):
+        """Drop the orphans which are too old to be included in period_number
+        """
+        self.parent_queue.expire(period_number)
+
+    def include_collation(self, collation_hash, blockhash, block_number, prevhash, head_blockhash):
+        """Set the head collation of a block which includes the given collation,
+        and the head of the shard to the head collation of head_blockhash
+
+        Return False if the collation is not in db
+        """
+        if collation_hash not in self.db:
+            return False
+        self._add_head_collation_block(blockhash, block_number)
+        self.collation_blockhash_lists.append(collation_hash, blockhash)
+        # Compare score
+        if self.get_score_of_collation_hash(collation_hash) > self.get_head_coll_score(prevhash):
+            self.head_collation_of_block[blockhash] = collation_hash
+        else:
+            self.head_collation_of_block[blockhash] = self.head_collation_of_block[prevhash]
+        self.update_head(self.head_collation_of_block[head_blockhash])
+        self.db.commit()
+        return True
+
+    def follow_block(self, blockhash, block_number, prevhash, head_blockhash):
+        """Set the head collation of a block which doesn't include a collation
+        of this shard to the head collation of its parent
+        """
+        self._add_head_collation_block(blockhash, block_number)
+        if prevhash in self.head_collation_of_block:
+            self.head_collation_of_block[blockhash] = self.head_collation_of_block[prevhash]
+            # Only the shards whose head moved rebuild their state
+            self.update_head(self.head_collation_of_block[head_blockhash])
+        else:
+            # The shard was just initialized
+            self.head_collation_of_block[blockhash] = self.head_hash
+        self.db.commit()
+
+    @property
+    def head_collation_pruned_number(self):
+        """The entries of head_collation_of_block are deleted up to this block number
+        """
+        key = 'shard_' + str(self.shard_id) + '_head_collation_pruned_number'
+        return int(self.db.get(key)) if key in self.db else None
+
+    def _add_head_collation_block(self, blockhash, block_number):
+        """Record the block number of a new entry of head_collation_of_block,
+        and delete the entries of the blocks which fall out of fork_choice_history
+        """
+        boundary = block_number - self.fork_choice_history
+        pruned_number = self.head_collation_pruned_number
+        if pruned_number is None:
+            # Nothing older is recorded
+            pruned_number = boundary
+        for number in range(pruned_number + 1, boundary + 1):
+            key = str_to_bytes(str(number))
+            if key not in self.head_collation_blocks:
+                continue
+            for h in self.head_collation_blocks[key]:
+                if h in self.head_collation_of_block:
+                    del self.head_collation_of_block[h]
+            del self.head_collation_blocks[key]
+        pruned_number = max(pruned_number, boundary)
+        self.db.put('shard_' + str(self.shard_id) + '_head_collation_pruned_number', str(pruned_number))
+        # A block of a stale fork is deleted with the next pruned number
+        self.head_collation_blocks.append(str_to_bytes(str(max(block_number, pruned_number + 1))), blockhash)
+
+    def get_blockhashes_of_better_collation(self, collation_hash):
+        """Get the hashes of the blocks which include the given collation if it
+        has a higher score than the head collation, or an empty list
+        """
+        if collation_hash not in self.collation_blockhash_lists:
+            return []
+        if self.get_score_of_collation_hash(collation_hash) <= self.get_score_of_collation_hash(self.head_hash):
+            return []
+        return self.collation_blockhash_lists[collation_hash]
+
+    def set_head_collation_of_blocks(self, collation_hash, blockhashes):
+        for blockhash in blockhashes:
+            self.head_collation_of_block[blockhash] = collation_hash
+        self.db.commit()
+
     def is_first_collation(self, collation):
         """Check if the given collation is the first collation of this shard
         """
@@ -0,0 +1,185 @@
+import os
+import logging
+import multiprocessing
+import threading
+
+import rlp
+
+from ethereum.slogging import get_logger
+from ethereum.config import Env
+from ethereum.block import Block
+from ethereum.state import State
+
+from sharding.collation import Collation
+from sharding.db import ShardDB
+from sharding.shard_chain import ShardChain
+
+log = get_logger('sharding.shard_executor')
+log.setLevel(logging.DEBUG)
+
+
+# The methods of ShardChain which the workers run with ShardExecutor.call
+SHARD_METHODS = (
+    'include_collation', 'follow_block', 'expire_orphans',
+    'get_blockhashes_of_better_collation', 'set_head_collation_of_blocks')
+
+
+def shard_db_path(db_dir, shard_id):
+    return os.path.join(db_dir, 'shard_%d' % shard_id)
+
+
+def run_shard_worker(conn, db_dir, config, global_config):
+    """The loop of a worker process
+
+    The worker owns the ShardChains and the ShardDBs of its shards, and
+    receives (command, shard_id, args) tuples until it gets None
+    """
+    shards = {}
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        command, shard_id, args = message
+        try:
+            if command == 'init_shard':
+                if shard_id not in shards:
+                    env = Env(ShardDB(shard_db_path(db_dir, shard_id)), config, global_config)
+                    if args is not None:
+                        # The genesis state is rebuilt on the db of the worker
+                        initial_state = State.from_snapshot(args, env)
+                        shards[shard_id] = ShardChain(shard_id=shard_id, initial_state=initial_state)
+                    else:
+                        shards[shard_id] = ShardChain(shard_id=shard_id, env=env)
+                result = shards[shard_id].head_hash
+            elif command == 'add_collations':
+                collation_rlps, block_rlps = args
+                shard = shards[shard_id]
+                collations = [rlp.decode(c, Collation) for c in collation_rlps]
+                blocks = [rlp.decode(b, Block) for b in block_rlps]
+                result = shard.add_collations(collations, blocks)
+            elif command == 'update_head':
+                result = shards[shard_id].update_head(args)
+                shards[shard_id].db.commit()
+            elif command == 'pop_orphans':
+                result = [rlp.encode(c) for c in shards[shard_id].parent_queue.pop(args)]
+            elif command in SHARD_METHODS:
+                result = getattr(shards[shard_id], command)(*args)
+            else:
+                raise ValueError('Unknown command %s' % command)
+            conn.send((True, result))
+        except Exception as e:
+            log.info('Shard worker command %s failed, exception: %s' % (command, str(e)))
+            conn.send((False, str(e)))
+    for shard in shards.values():
+        shard.db.commit()
+        shard.db.close()
+    conn.close()
+
+
+class ShardExecutor(object):
+    """Run the ShardChains of MainChain in a pool of worker processes
+
+    Each shard is owned by one worker, which keeps its state and its ShardDB
+    under `db_dir`, so the shards apply their collations in parallel. Only
+    collation and block RLPs and the verdicts go through the pipes.
+    """
+
+    def __init__(self, db_dir, config, global_config=None, processes=None):
+        self.db_dir = db_dir
+        self.processes = processes or multiprocessing.cpu_count()
+        self.workers = []
+        self.conns = []
+        self.shard_ids = set()
+        # The pipes are shared by the threads which call the executor
+        self.lock = threading.Lock()
+        for _ in range(self.processes):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=run_shard_worker,
+                args=(child_conn, db_dir, config, global_config or {}))
+            worker.daemon = True
+            worker.start()
+            child_conn.close()
+            self.workers.append(worker)
+            self.conns.append(parent_conn)
+
+    def _conn(self, shard_id):
+        return self.conns[shard_id % self.processes]
+
+    def _call(self, requests):
+        """Send the (command, shard_id, args) requests, then wait for all of them
+        """
+        with self.lock:
+            for command, shard_id, args in requests:
+                self._conn(shard_id).send((command, shard_id, args))
+            replies = [self._conn(shard_id).recv() for command, shard_id, args in requests]
+        results = []
+        for (command, shard_id, args), (ok, result) in zip(requests, replies):
+            if not ok:
+                raise Exception('Shard %d failed to %s: %s' % (shard_id, command, result))
+            results.append(result)
+        return results
+
+    def init_shard(self, shard_id, initial_state=None):
+        """Initialize the ShardChain in its worker and return its head hash
+
+        initial_state: the genesis state of the shard, an empty state if None,
+        it is sent to the worker as a snapshot
+        """
+        self.shard_ids.add(shard_id)
+        snapshot = initial_state.to_snapshot() if initial_state is not None else None
+        return self._call([('init_shard', shard_id, snapshot)])[0]
+
+    def has_shard(self, shard_id):
+        return shard_id in self.shard_ids
+
+    def add_collations(self, collations, period_start_prevblocks):
+        """Add the collations of any shards, the shards are applied in parallel
+
+        Return a list of whether each collation is added, the collations
+        without period_start_prevblock are not added
+        """
+        groups = {}
+        verdicts = [False] * len(collations)
+        for index, (collation, block) in enumerate(zip(collations, period_start_prevblocks)):
+            if block is None:
+                continue
+            group = groups.setdefault(collation.header.shard_id, ([], [], []))
+            group[0].append(index)
+            group[1].append(rlp.encode(collation))
+            group[2].append(rlp.encode(block))
+
+        shard_ids = sorted(groups)
+        requests = [('add_collations', shard_id, groups[shard_id][1:]) for shard_id in shard_ids]
+        for shard_id, shard_verdicts in zip(shard_ids, self._call(requests)):
+            for index, verdict in zip(groups[shard_id][0], shard_verdicts):
+                verdicts[index] = verdict
+        return verdicts
+
+    def update_head(self, shard_id, head_hash):
+        return self._call([('update_head', shard_id, head_hash)])[0]
+
+    def pop_orphans(self, shard_id, parent_collation_hash):
+        """Remove and return the orphans of the given parent from the shard
+        """
+        return [rlp.decode(c, Collation) for c in self._call([('pop_orphans', shard_id, parent_collation_hash)])[0]]
+
+    def call(self, shard_id, method, *args):
+        """Call one of SHARD_METHODS of the ShardChain in its worker
+        """
+        return self._call([(method, shard_id, args)])[0]
+
+    def call_shards(self, shard_ids, method, *args):
+        """Call one of SHARD_METHODS of the given shards, the workers run in parallel
+        """
+        return self._call([(method, shard_id, args) for shard_id in shard_ids])
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for worker in self.workers:
+            worker.join()
+        for conn in self.conns:
+            conn.close()
+        self.workers = []
+        self.conns = []
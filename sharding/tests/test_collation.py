@@ -1,6 +1,16 @@
+import pytest
+import logging
+import timeit
+
+from ethereum import utils
 from ethereum.utils import encode_hex
+from ethereum.slogging import get_logger
+
 from sharding.collation import CollationHeader, Collation
 
+log = get_logger('test.collation')
+log.setLevel(logging.DEBUG)
+
 
 def test_collation_init():
     """Test Collation initialization
@@ -14,3 +24,74 @@ def test_collation_init():
 
     assert collation.transaction_count == 0
     assert collation_header_dict['coinbase'] == encode_hex(coinbase)
+
+
+def test_collation_header_hash_cache():
+    """Test CollationHeader.hash and signing_hash are invalidated on mutation
+    """
+    collation_header = CollationHeader()
+    header_hash = collation_header.hash
+    signing_hash = collation_header.signing_hash
+    assert collation_header.hash == header_hash
+
+    # Mutating sig changes hash but not signing_hash
+    collation_header.sig = b'\x01' * 96
+    assert collation_header.hash != header_hash
+    assert collation_header.signing_hash == signing_hash
+
+    # Mutating other fields changes both
+    header_hash = collation_header.hash
+    collation_header.shard_id = 1
+    assert collation_header.hash != header_hash
+    assert collation_header.signing_hash != signing_hash
+    assert collation_header.hash == CollationHeader(shard_id=1, sig=b'\x01' * 96).hash
+
+
+def test_collation_attribute_access(monkeypatch):
+    """Test attribute access of Collation takes the normal lookup path and
+    its hash is only computed again after a mutation
+    """
+    collation = Collation(CollationHeader())
+    # No attribute lookup goes through a fallback
+    for cls in (Collation, CollationHeader):
+        assert cls.__getattribute__ is object.__getattribute__
+        assert not hasattr(cls, '__getattr__')
+
+    sha3_calls = []
+    sha3 = utils.sha3
+    monkeypatch.setattr(utils, 'sha3', lambda data: sha3_calls.append(data) or sha3(data))
+    header_hash = collation.hash
+    for _ in range(10):
+        assert collation.hash == collation.header.hash == header_hash
+    assert len(sha3_calls) == 1
+    assert collation.header.__dict__['_cached_hash'] == header_hash
+
+    # Delegated header fields
+    assert collation.shard_id == collation.header.shard_id
+    assert collation.hash == collation.header.hash
+    collation.shard_id = 2
+    assert collation.header.shard_id == 2
+    assert '_cached_hash' not in collation.header.__dict__
+    assert collation.hash != header_hash
+    assert len(sha3_calls) == 2
+
+    # The hashes are read-only
+    for name in ('hash', 'hex_hash', 'signing_hash'):
+        with pytest.raises(AttributeError):
+            setattr(collation, name, b'\x00' * 32)
+
+
+def test_collation_attribute_access_time():
+    """Compare the time of reading a delegated header field with a plain attribute,
+    the times are only logged
+    """
+    collation = Collation(CollationHeader())
+
+    class Plain(object):
+        pass
+    plain = Plain()
+    plain.shard_id = 0
+
+    delegated_time = min(timeit.repeat(lambda: collation.shard_id, number=10000, repeat=3))
+    plain_time = min(timeit.repeat(lambda: plain.shard_id, number=10000, repeat=3))
+    log.debug('Collation.shard_id: %.6fs, plain attribute: %.6fs per 10000 reads' % (delegated_time, plain_time))
@@ -1,13 +1,16 @@
 import pytest
 import logging
 
+from ethereum.config import config_metropolis
 from ethereum.slogging import get_logger
 from ethereum.transaction_queue import TransactionQueue
 from ethereum import utils
 from ethereum import trie
 
 from sharding import collator
+from sharding.collation import CollationHeader
 from sharding.tools import tester
+from sharding.validator_manager_utils import sign
 
 log = get_logger('test.collator')
 log.setLevel(logging.DEBUG)
@@ -89,6 +92,71 @@ def test_create_collation_with_txs():
     assert collation.transaction_count == 2
 
 
+def test_collation_builder():
+    """Test CollationBuilder with transactions arriving before sealing
+    """
+    shard_id = 1
+    t = chain(shard_id)
+
+    parent_collation_hash = t.chain.shards[shard_id].head_hash
+    expected_period_number = t.chain.get_expected_period_number()
+
+    builder = collator.CollationBuilder(t.chain, shard_id, tester.a0)
+    builder.reset(parent_collation_hash, expected_period_number)
+    empty_post_state_root = builder.collation.header.post_state_root
+    for key, to in ((tester.k2, tester.a4), (tester.k3, tester.a5)):
+        txqueue = TransactionQueue()
+        txqueue.add_transaction(t.generate_shard_tx(shard_id, key, to, int(0.03 * utils.denoms.ether)))
+        builder.add_transactions(txqueue)
+    # The execution results are ready before sealing
+    assert builder.collation.header.post_state_root != empty_post_state_root
+    post_state_root = builder.collation.header.post_state_root
+
+    collation = builder.seal(parent_collation_hash, expected_period_number, tester.k0)
+    assert collation.transaction_count == 2
+    assert collation.header.post_state_root == post_state_root
+    assert builder.collation is None
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    state = t.chain.shards[shard_id].mk_poststate_of_collation_hash(parent_collation_hash)
+    collator.apply_collation(state, collation, period_start_prevblock)
+
+    # A new candidate is built if there is none for the parent
+    assert not builder.is_candidate_of(parent_collation_hash, expected_period_number)
+    assert builder.seal(parent_collation_hash, expected_period_number, tester.k0).transaction_count == 0
+
+
+def test_collation_builder_reset():
+    """Test that the transactions of the candidate are kept when the parent moves
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+
+    parent_collation_hash = shard.head_hash
+    expected_period_number = t.chain.get_expected_period_number()
+    new_parent = collator.create_collation(
+        t.chain, shard_id, parent_collation_hash, expected_period_number,
+        coinbase=tester.a1, key=tester.k0, txqueue=None)
+    period_start_prevblock = t.chain.get_block(new_parent.header.period_start_prevhash)
+    assert shard.add_collation(new_parent, period_start_prevblock)
+
+    builder = collator.CollationBuilder(t.chain, shard_id, tester.a0)
+    builder.reset(parent_collation_hash, expected_period_number)
+    txqueue = TransactionQueue()
+    txqueue.add_transaction(t.generate_shard_tx(shard_id, tester.k2, tester.a4, int(0.03 * utils.denoms.ether)))
+    builder.add_transactions(txqueue)
+    assert len(txqueue) == 0
+    # The trie nodes of the candidate are not written to the shard db
+    assert builder.collation.header.post_state_root not in shard.db
+
+    collation = builder.seal(new_parent.header.hash, expected_period_number, tester.k0)
+    assert collation.transaction_count == 1
+    assert collation.header.parent_collation_hash == new_parent.header.hash
+    assert collation.header.post_state_root not in shard.db
+    state = shard.mk_poststate_of_collation_hash(new_parent.header.hash)
+    collator.apply_collation(state, collation, period_start_prevblock)
+
+
 def test_apply_collation():
     """Apply collation to ShardChain
     """
@@ -184,6 +252,7 @@ def test_verify_collation_header():
 
     # Verify collation header
     assert collator.verify_collation_header(t.chain, collation.header)
+    good_header = collation.header
 
     # Bad collation header 1
     collation = collator.create_collation(
@@ -210,3 +279,25 @@ def test_verify_collation_header():
     collation.header.sig = utils.sha3('hello')
     with pytest.raises(ValueError):
         collator.verify_collation_header(t.chain, collation.header)
+    bad_header = collation.header
+
+    # A child of good_header, which is only valid after good_header is added
+    child_header = CollationHeader(**dict((name, getattr(good_header, name)) for name, _ in CollationHeader.fields))
+    child_header.parent_collation_hash = good_header.hash
+    child_header.sig = sign(child_header.signing_hash, tester.k0)
+    with pytest.raises(ValueError):
+        collator.verify_collation_header(t.chain, child_header)
+
+    # Verify the headers together, a repeated header is rejected
+    assert collator.verify_collation_headers(t.chain, [good_header, bad_header, good_header]) == [True, False, False]
+    assert collator.verify_collation_headers(t.chain, [child_header, good_header, child_header]) == [False, True, True]
+
+
+def test_consensus_strategy():
+    """Test that the consensus strategies are shared by the configs with the same CONSENSUS_STRATEGY
+    """
+    configs = [dict(config_metropolis) for _ in range(10)]
+    cs = collator.consensus_strategy(configs[0])
+    count = len(collator._consensus_strategies)
+    assert all(collator.consensus_strategy(config) is cs for config in configs)
+    assert len(collator._consensus_strategies) == count
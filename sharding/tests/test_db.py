@@ -0,0 +1,119 @@
+import os
+import logging
+
+from ethereum.config import Env
+from ethereum.slogging import get_logger
+
+from sharding.tools import tester
+from sharding.db import WriteBatch, SegmentDB, ShardDB
+from sharding.shard_chain import ShardChain
+
+log = get_logger('test.db')
+log.setLevel(logging.DEBUG)
+
+
+def test_write_batch(tmpdir):
+    db = SegmentDB(str(tmpdir))
+    batch = WriteBatch(db)
+    batch.put(b'a', b'1')
+    batch.delete(b'b')
+    assert batch.get(b'a') == b'1'
+    assert b'a' not in db
+    batch.commit()
+    assert db.get(b'a') == b'1'
+    assert len(batch) == 0
+
+
+def test_segment_db(tmpdir):
+    path = str(tmpdir)
+    db = SegmentDB(path, segment_size=100)
+    for i in range(20):
+        db.put(b'key%d' % i, b'v' * i)
+    db.put('GENESIS_HASH', 'genesis')
+    db.commit()
+    db.delete(b'key1')
+    db.put(b'key2', b'new')
+    db.commit()
+    assert len(db.segments) > 1
+
+    # Reopen from disk, a torn record at the end is cut off
+    with open(os.path.join(path, '%08d.seg' % db.segments[-1]), 'ab') as f:
+        f.write(b'\x00\x00')
+    db = SegmentDB(path, segment_size=100)
+    assert db.get('GENESIS_HASH') == 'genesis'
+    assert b'key1' not in db
+    assert db.get(b'key2') == b'new'
+    assert db.get(b'key19') == b'v' * 19
+
+    db.compact()
+    db = SegmentDB(path)
+    assert len(db) == 20
+    assert db.get(b'key10') == b'v' * 10
+
+
+def test_segment_db_hints(tmpdir):
+    """Test that the index is loaded from the hint files of the full segments
+    """
+    path = str(tmpdir)
+    db = SegmentDB(path, segment_size=100)
+    for i in range(20):
+        db.put(b'key%d' % i, b'v' * i)
+        db.put('str%d' % i, 'value%d' % i)
+        db.commit()
+    db.delete(b'key1')
+    db.commit()
+    segments = db.segments
+    assert all(os.path.exists(db._hint_path(segment)) for segment in segments[:-1])
+    assert not os.path.exists(db._hint_path(segments[-1]))
+
+    scanned = []
+
+    class ScanCountingDB(SegmentDB):
+        def _scan_segment(self, segment):
+            scanned.append(segment)
+            return super(ScanCountingDB, self)._scan_segment(segment)
+
+    reopened = ScanCountingDB(path, segment_size=100)
+    assert scanned == [segments[-1]]
+    assert reopened.index == db.index
+
+    # A hint file which doesn't match its segment is ignored
+    with open(reopened._hint_path(segments[0]), 'wb') as f:
+        f.write(b'\x00' * 3)
+    del scanned[:]
+    reopened = ScanCountingDB(path, segment_size=100)
+    assert scanned == [segments[0], segments[-1]]
+    assert reopened.index == db.index
+    assert reopened.get('str3') == 'value3'
+    assert b'key1' not in reopened
+
+    reopened.compact()
+    assert not any(os.path.exists(reopened._hint_path(segment)) for segment in segments)
+    reopened = SegmentDB(path, segment_size=100)
+    assert len(reopened) == 39
+    assert reopened.get(b'key19') == b'v' * 19
+
+
+def test_shard_db(tmpdir):
+    """Test that the collations and the other data are stored separately
+    """
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+    db = ShardDB(str(tmpdir))
+    shard = ShardChain(shard_id=shard_id, env=Env(db, t.chain.env.config, t.chain.env.global_config))
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    assert shard.add_collation(collation, period_start_prevblock)
+
+    assert collation.header.hash in db.collations
+    assert collation.header.hash not in db.state
+    assert collation.header.post_state_root in db.state
+    assert shard.get_collation(collation.header.hash).header.hash == collation.header.hash
+
+    # The data survives reopening the db
+    db.close()
+    db = ShardDB(str(tmpdir))
+    assert db.get(collation.header.hash) == shard.db.get(collation.header.hash)
+    assert db.get(b'score:' + collation.header.hash) == '1'
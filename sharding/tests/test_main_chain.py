@@ -26,6 +26,57 @@ def test_init_shard():
     assert len(t.chain.shard_id_list) == 2
 
 
+def test_add_collations_of_untracked_shard():
+    """Test that the collations of the shards which are not tracked are not added
+    """
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(1)
+    t.mine(5)
+    untracked = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    untracked.header.shard_id = 2
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    assert t.chain.add_collations([untracked, collation]) == [False, True]
+
+
+def test_get_period_context():
+    """Test get_period_context(self, period_number)
+    """
+    t = tester.Chain(env='sharding')
+    t.mine(5)
+    context = t.chain.get_period_context(1)
+    assert t.chain.get_period_context(1) is context
+    assert context.period_start_prevhash == t.chain.get_blockhash_by_number(4)
+    assert context.period_start_prevblock.header.hash == context.period_start_prevhash
+    assert t.chain.get_period_start_prevhash(1) == context.period_start_prevhash
+
+    # A period which has not started is not cached
+    assert t.chain.get_period_context(2).period_start_prevblock is None
+    assert 2 not in t.chain.period_contexts
+
+    # Extending the head keeps the contexts
+    t.mine(5)
+    assert t.chain.get_period_context(1) is context
+    assert t.chain.get_period_context(2).period_start_prevblock is not None
+
+
+def test_get_child_hashes():
+    """Test that the child hashes cache is kept up to date and bounded
+    """
+    t = tester.Chain(env='sharding')
+    t.chain.max_child_hashes_cache = 2
+    t.mine(5)
+    blockhashes = [t.chain.get_blockhash_by_number(i) for i in range(6)]
+    for number in range(5):
+        assert t.chain.get_child_hashes(blockhashes[number]) == [blockhashes[number + 1]]
+    assert list(t.chain.child_hashes_cache) == blockhashes[3:5]
+
+    # A new child of the head is seen
+    assert t.chain.get_child_hashes(blockhashes[5]) == []
+    block = t.mine(1)
+    assert t.chain.get_child_hashes(blockhashes[5]) == [block.header.hash]
+    assert len(t.chain.child_hashes_cache) == 2
+
+
 def test_add_shard():
     """Test add_shard(self, shard)
     """
@@ -71,6 +122,65 @@ def test_get_period_start_prevhash():
     assert t.chain.get_period_start_prevhash(expected_period_number) is None
 
 
+def test_reorganize_all_shards():
+    """Test _reorganize_all_shards(self, block) only rebuilds moved shard heads
+    """
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(1)
+    t.chain.init_shard(2)
+    t.mine(1)
+
+    shard_states = {shard_id: t.chain.shards[shard_id].state for shard_id in (1, 2)}
+    t.mine(5)
+    for shard_id in (1, 2):
+        assert t.chain.shards[shard_id].head_collation_of_block[t.chain.head_hash] == t.chain.shards[shard_id].head_hash
+        assert t.chain.shards[shard_id].state is shard_states[shard_id]
+
+
+def test_expire_orphans():
+    """Test that the orphan pools are expired once per period
+    """
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(1)
+    shard = t.chain.shards[1]
+    expired = []
+    expire = shard.parent_queue.expire
+    shard.parent_queue.expire = lambda period_number: expired.append(period_number) or expire(period_number)
+
+    t.mine(12)
+    period_length = t.chain.env.config['PERIOD_LENGTH']
+    assert expired == sorted(set(n // period_length for n in range(1, 13)))
+
+    # No PERIOD_LENGTH is needed without shards
+    t = tester.Chain()
+    t.mine(2)
+
+
+def test_update_head_collation_of_block():
+    """Test update_head_collation_of_block(self, collation)
+    """
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+    shard = t.chain.shards[shard_id]
+
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    shard.add_collation(collation, period_start_prevblock, t.chain.handle_ignored_collation)
+
+    # The collation arrives late, after the block including it and its descendants
+    including_blockhash = t.chain.get_blockhash_by_number(3)
+    shard.collation_blockhash_lists.append(collation.header.hash, including_blockhash)
+    assert t.chain.update_head_collation_of_block(collation)
+    for number in range(3, 6):
+        blockhash = t.chain.get_blockhash_by_number(number)
+        assert shard.head_collation_of_block[blockhash] == collation.header.hash
+    assert shard.head_collation_of_block[t.chain.get_blockhash_by_number(2)] != collation.header.hash
+    # The blockhash list is left untouched
+    assert shard.collation_blockhash_lists[collation.header.hash] == [including_blockhash]
+
+
 def test_handle_ignored_collation():
     """Test handle_ignored_collation(self, collation, period_start_prevblock, handle_ignored_collation)
     """
@@ -108,6 +218,7 @@ def test_handle_ignored_collation():
     assert t2.chain.shards[shard_id].get_score(collation1) == 1
     assert t2.chain.shards[shard_id].get_score(collation2) == 2
     assert t2.chain.shards[shard_id].get_score(collation3) == 3
+    assert len(t2.chain.shards[shard_id].parent_queue) == 0
 
 
 @pytest.fixture(scope='function')
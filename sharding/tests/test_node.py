@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+from ethereum.slogging import get_logger
+
+from sharding.tools import tester
+from sharding.node import ShardNode, ReorgEvent
+
+log = get_logger('test.node')
+log.setLevel(logging.DEBUG)
+
+
+def test_shard_node():
+    """Test that the node imports collations and blocks and publishes the new shard head
+    """
+    shard_id = 1
+    # The chain which makes the blocks and the collation
+    t1 = tester.Chain(env='sharding')
+    t1.chain.init_shard(shard_id)
+    t1.mine(5)
+    collation = t1.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    block = t1.mine(1)
+
+    # The chain of the node
+    t2 = tester.Chain(env='sharding')
+    t2.chain.init_shard(shard_id)
+    t2.mine(5)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    node = ShardNode(t2.chain, loop=loop)
+    events = node.subscribe()
+    verified = []
+
+    async def run():
+        node.start()
+        node.submit_collation(collation)
+        node.submit_header(collation.header, lambda header, result: verified.append(result))
+        await node.join()
+        node.submit_block(block, collation)
+        await node.join()
+        node.stop()
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+    assert verified == [False]
+    assert t2.chain.shards[shard_id].head_hash == collation.header.hash
+    received = []
+    while not events.empty():
+        received.append(events.get_nowait())
+    assert ReorgEvent(None, block.header.prevhash, block.header.hash) in received
+    assert ReorgEvent(shard_id, t2.chain.env.config['GENESIS_PREVHASH'], collation.header.hash) in received
@@ -0,0 +1,74 @@
+import logging
+
+from ethereum import utils
+from ethereum.slogging import get_logger
+
+from sharding.sampler import CycleTable, Sampler
+from sharding.tools import tester
+from sharding.validator_manager_utils import call_sample
+from sharding.validator_manager_view import ZERO_ADDR
+
+log = get_logger('test.sampler')
+log.setLevel(logging.DEBUG)
+
+
+def test_sampler():
+    """Test that Sampler agrees with sample of the contract
+    """
+    t = tester.Chain(env='sharding', deploy_sharding_contracts=True)
+    t.mine(5)
+    valcode_addrs = []
+    for privkey in (tester.k0, tester.k1):
+        valcode_addr = t.sharding_valcode_addr(privkey)
+        t.sharding_deposit(privkey, valcode_addr)
+        valcode_addrs.append(valcode_addr)
+    t.mine(1)
+
+    sampler = Sampler()
+    state = t.head_state
+    sampled = [call_sample(state, shard_id)[-20:] for shard_id in range(100)]
+    assert [sampler.sample(state, shard_id) for shard_id in range(100)] == sampled
+
+    period_number = state.block_number // t.chain.env.config['PERIOD_LENGTH']
+    schedules = [sampler.get_schedule(state, addr) for addr in valcode_addrs]
+    for addr, schedule in zip(valcode_addrs, schedules):
+        assert schedule == [(period_number, shard_id) for shard_id in range(100) if sampled[shard_id] == addr]
+    assert len(schedules[0]) + len(schedules[1]) == 100
+    assert len(sampler.tables) == 1
+
+    # The validator set is read again after a withdrawal
+    t.sharding_withdraw(tester.k0, 0)
+    t.mine(1)
+    state = t.head_state
+    assert [sampler.sample(state, shard_id) for shard_id in range(100)] == \
+        [call_sample(state, shard_id)[-20:] for shard_id in range(100)] == [valcode_addrs[1]] * 100
+    assert sampler.get_schedule(state, valcode_addrs[0]) == []
+    assert len(sampler.tables) == 2
+
+    # A withdrawal and a deposit which keep the number of validators
+    valcode_addr = t.sharding_valcode_addr(tester.k2)
+    t.sharding_withdraw(tester.k1, 0)
+    t.sharding_deposit(tester.k2, valcode_addr)
+    t.mine(1)
+    state = t.head_state
+    assert [sampler.sample(state, shard_id) for shard_id in range(100)] == \
+        [call_sample(state, shard_id)[-20:] for shard_id in range(100)] == [valcode_addr] * 100
+    assert len(sampler.tables) == 3
+
+    assert CycleTable(utils.sha3('cycle'), [], 100, 100).sample(utils.sha3('period'), 0) == ZERO_ADDR
+
+
+def test_cycle_table():
+    """Test the schedule of the validators over the periods of a cycle
+    """
+    validation_code_addrs = [utils.sha3(str(i))[-20:] for i in range(30)]
+    table = CycleTable(utils.sha3('cycle'), validation_code_addrs, 100, 100)
+    period_seeds = dict((period_number, utils.sha3(str(period_number))) for period_number in range(50))
+
+    schedules = [table.get_schedule(addr, period_seeds) for addr in validation_code_addrs]
+    assert table.get_schedule(ZERO_ADDR, period_seeds) == []
+    assert sorted(sum(schedules, [])) == \
+        [(period_number, shard_id) for period_number in range(50) for shard_id in range(100)]
+    for addr, schedule in zip(validation_code_addrs, schedules):
+        for period_number, shard_id in schedule:
+            assert table.sample(period_seeds[period_number], shard_id) == addr
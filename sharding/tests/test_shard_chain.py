@@ -8,7 +8,8 @@ from ethereum import utils
 from ethereum import trie
 
 from sharding.tools import tester
-from sharding.shard_chain import ShardChain
+from sharding.shard_chain import ShardChain, OrphanPool
+from sharding.collation import Collation, CollationHeader
 
 log = get_logger('test.shard_chain')
 log.setLevel(logging.DEBUG)
@@ -60,6 +61,222 @@ def test_add_collation():
     assert t.chain.shards[shard_id].get_score(collation4) == 3
 
 
+def test_backfill_score():
+    """Test backfill_score(self, collation_hash)
+    """
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+
+    shard = t.chain.shards[shard_id]
+    collation1 = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation1.header.period_start_prevhash)
+    shard.add_collation(collation1, period_start_prevblock, t.chain.handle_ignored_collation)
+    collation2 = t.generate_collation(shard_id=1, coinbase=tester.a2, key=tester.k1, txqueue=None, parent_collation_hash=collation1.header.hash)
+    shard.add_collation(collation2, period_start_prevblock, t.chain.handle_ignored_collation)
+
+    # add_collation writes the score index
+    assert int(shard.db.get(b'score:' + collation2.header.hash)) == 2
+
+    # Scores missing from an old database are filled in
+    shard.db.delete(b'score:' + collation1.header.hash)
+    shard.db.delete(b'score:' + collation2.header.hash)
+    assert shard.backfill_score(collation2.header.hash) == 2
+    assert int(shard.db.get(b'score:' + collation1.header.hash)) == 1
+    assert shard.get_score(collation2) == 2
+
+    # A collation which is not in db scores one more than its parent
+    collation3 = t.generate_collation(shard_id=1, coinbase=tester.a3, key=tester.k1, txqueue=None, parent_collation_hash=collation2.header.hash)
+    assert collation3.header.hash not in shard.db
+    assert shard.get_score(collation3) == 3
+    assert b'score:' + collation3.header.hash not in shard.db
+
+
+def test_restore_from_db():
+    """Test that a new ShardChain on the same db restores the head and the fork choice indexes
+    """
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+
+    shard = t.chain.shards[shard_id]
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    assert shard.add_collation(collation, period_start_prevblock)
+    shard.collation_blockhash_lists.append(collation.header.hash, t.chain.head_hash)
+    shard.head_collation_of_block[t.chain.head_hash] = collation.header.hash
+    assert shard.update_head(collation.header.hash)
+    shard.db.commit()
+
+    restored = ShardChain(shard_id=shard_id, env=t.chain.env)
+    assert restored.head_hash == collation.header.hash
+    assert restored.state.trie.root_hash == collation.header.post_state_root
+    assert restored.collation_blockhash_lists[collation.header.hash] == [t.chain.head_hash]
+    assert restored.head_collation_of_block[t.chain.head_hash] == collation.header.hash
+    assert t.chain.head_hash not in ShardChain(shard_id=2, env=t.chain.env).head_collation_of_block
+
+
+def test_head_collation_index():
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    shard = ShardChain(shard_id=shard_id, env=t.chain.env, fork_choice_cache_size=4)
+    collation_hashes = [utils.sha3('collation%d' % i) for i in range(2)]
+    for i in range(10):
+        shard.head_collation_of_block[utils.sha3('block%d' % i)] = collation_hashes[i // 5]
+
+    # Only the recent blocks are in memory, and their collation hashes are interned
+    index = shard.head_collation_of_block
+    assert len(index) == 4
+    assert index.evicted == 6
+    assert list(index.collation_hashes) == [collation_hashes[1]]
+    assert index.collation_hashes[collation_hashes[1]][1] == 4
+
+    # The evicted blocks are read from db
+    assert index[utils.sha3('block0')] == collation_hashes[0]
+    assert len(index) == 4
+    assert index.collation_hashes[collation_hashes[0]][1] == 1
+
+
+def test_head_collation_pruning():
+    """Test that the entries of the old blocks are deleted from the db of head_collation_of_block
+    """
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    shard = ShardChain(shard_id=shard_id, env=t.chain.env, fork_choice_history=3)
+    assert t.chain.add_shard(shard)
+    t.mine(1)
+    blockhashes = [t.mine(1).header.hash for _ in range(6)]
+    prefix = shard.head_collation_of_block.prefix
+
+    # The blocks more than 3 blocks behind the head are deleted
+    assert shard.head_collation_pruned_number == t.chain.state.block_number - 3
+    for blockhash in blockhashes[:3]:
+        assert blockhash not in shard.head_collation_of_block
+        assert prefix + blockhash not in shard.db
+    for blockhash in blockhashes[3:]:
+        assert shard.head_collation_of_block[blockhash] == shard.head_hash
+
+    # A block of a stale fork is deleted with the next block
+    stale_hash = utils.sha3('stale')
+    shard.follow_block(stale_hash, 1, blockhashes[0], t.chain.head_hash)
+    assert stale_hash in shard.head_collation_of_block
+    t.mine(1)
+    assert stale_hash not in shard.head_collation_of_block
+
+
+def test_prune():
+    """Test prune(self)
+    """
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    shard = ShardChain(shard_id=shard_id, env=t.chain.env, max_history=1, prune_interval=1)
+    assert t.chain.add_shard(shard)
+    t.mine(5)
+
+    def add(coinbase, parent_collation_hash=None):
+        collation = t.generate_collation(
+            shard_id=shard_id, coinbase=coinbase, key=tester.k1, txqueue=None,
+            parent_collation_hash=parent_collation_hash)
+        period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+        assert shard.add_collation(collation, period_start_prevblock, t.chain.handle_ignored_collation)
+        return collation
+
+    # collation1 -> collation2 -> collation3 and collation1 -> fork2
+    collation1 = add(tester.a1)
+    collation2 = add(tester.a1, collation1.header.hash)
+    fork2 = add(tester.a2, collation1.header.hash)
+    collation3 = add(tester.a1, collation2.header.hash)
+    assert shard.get_collation_hashes_by_score(2) == [collation2.header.hash, fork2.header.hash]
+
+    # Moving the head prunes the scores below the history window
+    assert shard.update_head(collation3.header.hash)
+    assert shard.pruned_score == 2
+    assert shard.pruned_collations == 1
+    assert shard.pruned_bytes > 0
+    assert fork2.header.hash not in shard.db
+    assert b'deletes:' + collation1.header.hash not in shard.db
+    assert b'deletes:' + collation2.header.hash not in shard.db
+    assert shard.get_collation_hashes_by_score(2) == []
+
+    # The states in the window are intact
+    state = shard.mk_poststate_of_collation_hash(collation3.header.hash)
+    assert state.get_balance(tester.a1) == 3 * int(shard.env.config['COLLATOR_REWARD'])
+
+
+def test_add_collations():
+    """Test add_collations(self, collations, period_start_prevblocks, handle_ignored_collation)
+    """
+    shard_id = 1
+    # Collator: create and apply collation sequentially
+    t1 = tester.Chain(env='sharding')
+    t1.chain.init_shard(shard_id)
+    t1.mine(5)
+    collations = []
+    parent_collation_hash = None
+    for i in range(3):
+        collation = t1.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None, parent_collation_hash=parent_collation_hash)
+        period_start_prevblock = t1.chain.get_block(collation.header.period_start_prevhash)
+        assert t1.chain.shards[shard_id].add_collation(collation, period_start_prevblock, t1.chain.handle_ignored_collation)
+        collations.append(collation)
+        parent_collation_hash = collation.header.hash
+
+    # Validator: apply the whole chain at once
+    t2 = tester.Chain(env='sharding')
+    t2.chain.init_shard(shard_id)
+    t2.mine(5)
+    shard = t2.chain.shards[shard_id]
+    period_start_prevblocks = [t2.chain.get_block(c.header.period_start_prevhash) for c in collations]
+    assert shard.add_collations(collations, period_start_prevblocks, t2.chain.handle_ignored_collation) == [True, True, True]
+    for score, collation in enumerate(collations, 1):
+        assert shard.get_score(collation) == score
+        assert b'deletes:' + collation.header.hash in shard.db
+    state = shard.mk_poststate_of_collation_hash(collations[-1].header.hash)
+    assert state.trie.root_hash == collations[-1].header.post_state_root
+
+    # An invalid collation does not stop the following ones
+    t3 = tester.Chain(env='sharding')
+    t3.chain.init_shard(shard_id)
+    t3.mine(5)
+    invalid = t1.generate_collation(shard_id=1, coinbase=tester.a2, key=tester.k1, txqueue=None)
+    invalid.header.post_state_root = trie.BLANK_ROOT
+    results = t3.chain.shards[shard_id].add_collations([invalid, collations[0]], period_start_prevblocks[:2])
+    assert results == [False, True]
+
+
+def test_write_batch():
+    """Test write_batch(self)
+    """
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+    shard = t.chain.shards[shard_id]
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+
+    # Nothing reaches the env db before the outermost batch is committed
+    with shard.write_batch() as batch:
+        with shard.write_batch() as inner_batch:
+            assert inner_batch is batch
+            assert shard.add_collation(collation, period_start_prevblock)
+        assert collation.header.hash in shard.db
+        assert collation.header.hash not in shard.env.db
+        assert len(batch) > 0
+    assert collation.header.hash in shard.env.db
+    assert shard.get_score(collation) == 1
+    state = shard.mk_poststate_of_collation_hash(collation.header.hash)
+    assert state.trie.root_hash == collation.header.post_state_root
+
+    # A failed block leaves the env db untouched
+    with pytest.raises(ValueError):
+        with shard.write_batch() as batch:
+            batch.put(b'junk', b'junk')
+            raise ValueError()
+    assert b'junk' not in shard.env.db
+
+
 def test_add_collation_error():
     """Test add_collation(self, collation, period_start_prevblock, handle_ignored_collation)
     """
@@ -122,6 +339,37 @@ def test_handle_ignored_collation():
     assert t2.chain.shards[shard_id].get_score(collation3) == 3
 
 
+def test_orphan_pool():
+    """Test OrphanPool
+    """
+    pool = OrphanPool(max_size=2, max_periods=1)
+    parent_hash = utils.sha3('parent')
+    orphan1 = Collation(CollationHeader(parent_collation_hash=parent_hash, expected_period_number=1))
+    orphan2 = Collation(CollationHeader(parent_collation_hash=parent_hash, expected_period_number=2))
+    orphan3 = Collation(CollationHeader(parent_collation_hash=utils.sha3('other'), expected_period_number=3))
+
+    assert pool.add(orphan1)
+    assert not pool.add(orphan1)
+    assert pool.duplicates == 1
+    assert pool.add(orphan2)
+    assert parent_hash in pool
+    assert pool[parent_hash] == [orphan1, orphan2]
+
+    # The oldest arrival is evicted when the pool is full
+    assert pool.add(orphan3)
+    assert len(pool) == 2
+    assert pool.evicted == 1
+    assert pool[parent_hash] == [orphan2]
+
+    # Expire the orphans of old periods
+    pool.expire(4)
+    assert pool.expired == 1
+    assert parent_hash not in pool
+
+    assert pool.pop(orphan3.header.parent_collation_hash) == [orphan3]
+    assert len(pool) == 0
+
+
 def test_transaction():
     """Test create and apply collation with transactions
     """
@@ -156,6 +404,43 @@ def test_transaction():
         state = t.chain.shards[shard_id].mk_poststate_of_collation_hash(b'1234')
 
 
+def test_post_state_cache():
+    """Test the post-state cache of mk_poststate_of_collation_hash
+    """
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    shard = ShardChain(shard_id=shard_id, env=t.chain.env, post_state_cache_size=1)
+    assert t.chain.add_shard(shard)
+    t.mine(5)
+
+    collation = t.generate_collation(shard_id=shard_id, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    assert shard.add_collation(collation, period_start_prevblock, t.chain.handle_ignored_collation)
+    # add_collation caches the post-state for the children
+    assert collation.header.hash in shard.post_state_cache
+    shard.post_state_cache.discard(collation.header.hash)
+
+    misses = shard.post_state_cache.misses
+    state1 = shard.mk_poststate_of_collation_hash(collation.header.hash)
+    assert shard.post_state_cache.misses == misses + 1
+    hits = shard.post_state_cache.hits
+    state2 = shard.mk_poststate_of_collation_hash(collation.header.hash)
+    assert shard.post_state_cache.hits == hits + 1
+
+    # Every caller gets its own copy
+    assert state1 is not state2
+    assert state1.trie.root_hash == state2.trie.root_hash == collation.header.post_state_root
+    state2.delta_balance(tester.a1, 1)
+    state2.commit()
+    state3 = shard.mk_poststate_of_collation_hash(collation.header.hash)
+    assert state3.get_balance(tester.a1) == state1.get_balance(tester.a1)
+
+    # The cache is bounded
+    shard.mk_poststate_of_collation_hash(shard.env.config['GENESIS_PREVHASH'])
+    assert len(shard.post_state_cache) == 1
+    assert collation.header.hash not in shard.post_state_cache
+
+
 def test_get_collation():
     """Test get_parent(self, collation)
     """
@@ -172,6 +457,25 @@ def test_get_collation():
     assert t.chain.shards[shard_id].get_collation(collation.header.hash).header.hash == collation.header.hash
 
 
+def test_get_collation_header():
+    """Test get_collation_header(self, collation_hash)
+    """
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    t.chain.shards[shard_id].add_collation(collation, period_start_prevblock, t.chain.handle_ignored_collation)
+
+    header = t.chain.shards[shard_id].get_collation_header(collation.header.hash)
+    assert header == collation.header
+    assert header.post_state_root == collation.header.post_state_root
+    assert t.chain.shards[shard_id].get_collation_header(b'1234') is None
+
+
 def test_get_parent():
     """Test get_parent(self, collation)
     """
@@ -0,0 +1,101 @@
+import logging
+
+import pytest
+from ethereum import utils
+from ethereum.config import Env
+from ethereum.slogging import get_logger
+from ethereum.state import State
+from ethereum.transaction_queue import TransactionQueue
+
+from sharding.collator import CollationBuilder
+from sharding.tools import tester
+from sharding.shard_executor import ShardExecutor
+
+log = get_logger('test.shard_executor')
+log.setLevel(logging.DEBUG)
+
+
+def test_shard_executor(tmpdir):
+    """Test that the workers apply the collations of their shards
+    """
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(1)
+    t.chain.init_shard(2)
+    t.mine(5)
+    collation1 = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    assert t.chain.shards[1].add_collation(collation1, t.chain.get_block(collation1.header.period_start_prevhash))
+    collation2 = t.generate_collation(shard_id=2, coinbase=tester.a2, key=tester.k1, txqueue=None)
+    child = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None, parent_collation_hash=collation1.header.hash)
+    collations = [collation1, collation2, child]
+
+    period_start_prevblocks = [t.chain.get_block(c.header.period_start_prevhash) for c in collations]
+
+    executor = ShardExecutor(str(tmpdir), t.chain.env.config, t.chain.env.global_config, processes=2)
+    try:
+        for shard_id in (1, 2):
+            assert executor.init_shard(shard_id) == t.chain.env.config['GENESIS_PREVHASH']
+        assert executor.add_collations(collations, period_start_prevblocks) == [True, True, True]
+        assert executor.update_head(1, child.header.hash)
+    finally:
+        executor.close()
+
+
+def test_shard_executor_initial_state(tmpdir):
+    """Test that the workers start the shards from the given genesis state
+    """
+    shard_id = 3
+    t = tester.Chain(env='sharding')
+    initial_state = State(env=Env(config=t.chain.env.config))
+    initial_state.set_balance(tester.a5, utils.denoms.ether)
+    initial_state.commit()
+    t.chain.init_shard(shard_id, initial_state=initial_state)
+    t.mine(5)
+
+    # The tx is only valid on the given genesis state
+    t.set_collation(shard_id, t.chain.get_expected_period_number())
+    txqueue = TransactionQueue()
+    txqueue.add_transaction(t.generate_shard_tx(shard_id, tester.k5, tester.a6, int(0.03 * utils.denoms.ether)))
+    collation = t.generate_collation(shard_id=shard_id, coinbase=tester.a1, key=tester.k1, txqueue=txqueue)
+    assert collation.transaction_count == 1
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+
+    executor = ShardExecutor(str(tmpdir), t.chain.env.config, t.chain.env.global_config, processes=2)
+    try:
+        executor.init_shard(shard_id, initial_state)
+        executor.init_shard(shard_id + 1)
+        assert executor.add_collations([collation], [period_start_prevblock]) == [True]
+    finally:
+        executor.close()
+
+
+def test_main_chain_with_shard_executor(tmpdir):
+    """Test that MainChain routes the orphans and the head updates of its
+    shards to the workers
+    """
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+    collation1 = t.generate_collation(shard_id=shard_id, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    assert t.chain.shards[shard_id].add_collation(collation1, t.chain.get_block(collation1.header.period_start_prevhash))
+    child = t.generate_collation(shard_id=shard_id, coinbase=tester.a1, key=tester.k1, txqueue=None, parent_collation_hash=collation1.header.hash)
+
+    executor = ShardExecutor(str(tmpdir), t.chain.env.config, t.chain.env.global_config, processes=1)
+    try:
+        # The shard is run by the worker from now on
+        del t.chain.shards[shard_id]
+        t.chain.shard_executor = executor
+        executor.init_shard(shard_id)
+        with pytest.raises(ValueError):
+            CollationBuilder(t.chain, shard_id, tester.a1)
+
+        # The child waits for its parent in the orphan pool of the worker
+        assert t.chain.add_collations([child, collation1]) == [False, True]
+        assert executor.pop_orphans(shard_id, collation1.header.hash) == []
+
+        block = t.mine(1)
+        t.chain.reorganize_head_collation(block, child)
+        # The child is the head collation of the block and the head of the shard
+        assert not executor.update_head(shard_id, child.header.hash)
+    finally:
+        executor.close()
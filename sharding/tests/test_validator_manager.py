@@ -1,7 +1,11 @@
+import os
+import logging
+
 import pytest
 import rlp
 
 from ethereum import utils
+from ethereum.slogging import get_logger
 from sharding.tools import tester as t
 from rlp.sedes import List, binary
 
@@ -14,6 +18,9 @@ from sharding.validator_manager_utils import (get_valmgr_addr,
                                               WITHDRAW_HASH,
                                               DEPOSIT_SIZE)
 
+log = get_logger('test.validator_manager')
+log.setLevel(logging.DEBUG)
+
 validator_manager_code = get_valmgr_code()
 
 
@@ -49,9 +56,16 @@ def test_validator_manager():
     assert x.withdraw(0, sign(WITHDRAW_HASH, t.k0))
     # test withdraw: see if the money is returned
     assert c.head_state.get_balance(return_addr) == DEPOSIT_SIZE
-    # test deposit: make use of empty slots
-    assert 0 == x.deposit(k0_valcode_addr, return_addr, value=DEPOSIT_SIZE, sender=t.k0)
-    assert x.withdraw(1, sign(WITHDRAW_HASH, t.k1))
+    # test withdraw: the last validator is moved into the withdrawn slot
+    assert x.get_num_validators() == 1
+    assert x.get_validators__validation_code_addr(0) == hex(utils.big_endian_to_int(k1_valcode_addr))
+    assert x.get_validator_index_of(k1_valcode_addr) == 0
+    # test deposit: appends to the packed validators
+    assert 1 == x.deposit(k0_valcode_addr, return_addr, value=DEPOSIT_SIZE, sender=t.k0)
+    assert x.get_validator_index_of(k0_valcode_addr) == 1
+    assert x.withdraw(x.get_validator_index_of(k1_valcode_addr), sign(WITHDRAW_HASH, t.k1))
+    assert x.get_validators__validation_code_addr(0) == hex(utils.big_endian_to_int(k0_valcode_addr))
+    assert x.get_validator_index_of(k0_valcode_addr) == 0
     # test deposit: working fine in the edge condition
     assert 1 == x.deposit(k1_valcode_addr, return_addr, value=DEPOSIT_SIZE, sender=t.k1)
     # test deposit: fails when valcode_addr is deposited before
@@ -64,9 +78,9 @@ def test_validator_manager():
     assert x.withdraw(0, sign(WITHDRAW_HASH, t.k0))
     assert x.sample(0) == hex(utils.big_endian_to_int(k1_valcode_addr))
     # test sample: sample returns zero_addr (i.e. 0x00) when there is no depositing validator
-    assert x.withdraw(1, sign(WITHDRAW_HASH, t.k1))
+    assert x.withdraw(0, sign(WITHDRAW_HASH, t.k1))
     assert x.sample(0) == "0x0000000000000000000000000000000000000000"
-    assert 1 == x.deposit(k0_valcode_addr, return_addr, value=DEPOSIT_SIZE, sender=t.k0)
+    assert 0 == x.deposit(k0_valcode_addr, return_addr, value=DEPOSIT_SIZE, sender=t.k0)
 
     def get_colhdr(shard_id, parent_collation_hash, collation_coinbase=t.a0):
         period_length = 5
@@ -166,3 +180,60 @@ def test_validator_manager():
         current_colhdr_hash = utils.sha3(current_colhdr)
     assert x.get_ancestor(shard_id, current_colhdr_hash) == shard0_genesis_colhdr_hash
     '''
+
+
+def test_sample_gas():
+    """Benchmark the gas of sample and withdraw before and after validators
+    withdraw, against the contract which left empty slots
+    """
+    c = t.Chain()
+    keys = [t.k0, t.k1, t.k2, t.k3, t.k4, t.k5, t.k6, t.k7, t.k8, t.k9]
+    validators = [(key, c.tx(key, '', 0, mk_validation_code(utils.privtoaddr(key)))) for key in keys]
+    c.mine(10)
+    c.head_state.gas_limit = 10 ** 12
+    for key in keys:
+        c.head_state.set_balance(address=utils.privtoaddr(key), value=DEPOSIT_SIZE * 10)
+    for tx in mk_initiating_contracts(t.k0, c.head_state.get_nonce(t.a0)):
+        c.direct_tx(tx)
+    with open(os.path.join(os.path.dirname(__file__), 'contracts/validator_manager_empty_slots.v.py')) as f:
+        old_code = f.read()
+    contracts = [
+        ('empty slots', c.contract(old_code, language='viper', startgas=4000000)),
+        ('packed', t.ABIContract(c, get_valmgr_ct(), get_valmgr_addr())),
+    ]
+
+    def gas_of(func, *args, **kwargs):
+        gas_used = c.head_state.gas_used
+        result = func(*args, **kwargs)
+        return result, c.head_state.gas_used - gas_used
+
+    # The shard_ids have the same number of nonzero bytes of call data
+    shard_ids = range(1, 11)
+    gas = {}
+    for name, x in contracts:
+        for key, valcode_addr in validators:
+            x.deposit(valcode_addr, utils.privtoaddr(key), value=DEPOSIT_SIZE, sender=key)
+        gas[name, 'sample'] = [gas_of(x.sample, shard_id)[1] for shard_id in shard_ids]
+        # Withdraw 8 of the 10 validators
+        gas[name, 'withdraw'] = []
+        for index, (key, valcode_addr) in enumerate(validators[:8]):
+            if name == 'packed':
+                # The validators moved into the withdrawn slots have new indexes
+                index = x.get_validator_index_of(valcode_addr)
+            result, withdraw_gas_used = gas_of(x.withdraw, index, sign(WITHDRAW_HASH, key), sender=key)
+            assert result
+            gas[name, 'withdraw'].append(withdraw_gas_used)
+        remaining = set(utils.big_endian_to_int(valcode_addr) for _, valcode_addr in validators[8:])
+        gas[name, 'sample after withdraw'] = []
+        for shard_id in shard_ids:
+            addr, sample_gas_used = gas_of(x.sample, shard_id)
+            assert int(addr, 16) in remaining
+            gas[name, 'sample after withdraw'].append(sample_gas_used)
+    for (name, func), gas_used in sorted(gas.items()):
+        log.debug('%s %s: min %d, max %d gas' % (name, func, min(gas_used), max(gas_used)))
+
+    # One hash and one validator read whatever the churn was
+    assert len(set(gas['packed', 'sample'] + gas['packed', 'sample after withdraw'])) == 1
+    assert max(gas['packed', 'sample']) < min(gas['empty slots', 'sample'])
+    # The old sample retries on the empty slots
+    assert max(gas['empty slots', 'sample after withdraw']) > max(gas['empty slots', 'sample'])
@@ -14,6 +14,14 @@ from sharding.validator_manager_utils import (DEPOSIT_SIZE, WITHDRAW_HASH,
                                               call_msg_add_header,
                                               call_get_shard_head,
                                               get_valmgr_addr,
+                                              get_valmgr_artifact,
+                                              get_viper_version,
+                                              get_valmgr_bytecode,
+                                              get_valmgr_sender_addr,
+                                              get_valmgr_tx,
+                                              load_valmgr_artifact,
+                                              mk_valmgr_tx,
+                                              save_valmgr_artifact,
                                               mk_validation_code, sign,
                                               create_contract_tx)
 
@@ -116,8 +124,32 @@ def test_call_add_header_get_shard_head(chain):
 
 
 def test_valmgr_addr_in_sharding_config():
-    assert sharding_config['VALIDATOR_MANAGER_ADDRESS'] == \
-        utils.checksum_encode(get_valmgr_addr())
+    valmgr_addr = get_valmgr_addr()
+    assert sharding_config['VALIDATOR_MANAGER_ADDRESS'] == utils.checksum_encode(valmgr_addr)
+
+
+def test_valmgr_artifact(tmpdir):
+    """Test that the saved artifact matches the compiled contract, and is
+    ignored once the source or the viper version changes
+    """
+    artifact = get_valmgr_artifact()
+    tx, sender_addr, addr = mk_valmgr_tx(get_valmgr_bytecode())
+    assert get_valmgr_tx().hash == tx.hash
+    assert get_valmgr_sender_addr() == sender_addr == get_valmgr_tx().sender
+    assert get_valmgr_addr() == addr
+
+    path = str(tmpdir.join('validator_manager.json'))
+    assert load_valmgr_artifact(path) is None
+    save_valmgr_artifact(artifact, path)
+    assert load_valmgr_artifact(path) == artifact
+    save_valmgr_artifact(dict(artifact, source_hash=utils.encode_hex(utils.sha3('old source'))), path)
+    assert load_valmgr_artifact(path) is None
+    assert artifact['viper_version'] == get_viper_version() is not None
+    save_valmgr_artifact(dict(artifact, viper_version='0.0.0'), path)
+    assert load_valmgr_artifact(path) is None
+    with open(path, 'w') as f:
+        f.write('{"source_hash": ')
+    assert load_valmgr_artifact(path) is None
 
 
 def test_sign():
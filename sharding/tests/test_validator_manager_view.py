@@ -0,0 +1,133 @@
+import logging
+
+import pytest
+import rlp
+from ethereum import utils
+from ethereum.slogging import get_logger
+from ethereum.transaction_queue import TransactionQueue
+
+from sharding import collator
+from sharding.collation import CollationHeader
+from sharding.tools import tester
+from sharding.validator_manager_utils import (call_msg, call_msg_add_header, call_sample,
+                                              get_valmgr_addr, get_valmgr_ct, sign)
+from sharding.validator_manager_view import ValidatorManagerView
+
+log = get_logger('test.validator_manager_view')
+log.setLevel(logging.DEBUG)
+
+
+def chain(shard_id):
+    t = tester.Chain(env='sharding', deploy_sharding_contracts=True)
+    t.mine(5)
+    for privkey in (tester.k0, tester.k1):
+        valcode_addr = t.sharding_valcode_addr(privkey)
+        t.sharding_deposit(privkey, valcode_addr)
+    t.mine(1)
+    t.add_test_shard(shard_id)
+    return t
+
+
+def call_add_header(state, header):
+    """Whether add_header succeeds in the EVM
+    """
+    try:
+        result = call_msg_add_header(state, 0, rlp.encode(CollationHeader.serialize(header)), header.coinbase)
+        return bool(utils.big_endian_to_int(result))
+    except Exception:
+        return False
+
+
+def check_add_header(state, header):
+    try:
+        return ValidatorManagerView(state).check_add_header(header)
+    except ValueError:
+        return False
+
+
+def variant(header, key, **changes):
+    """A copy of header with the changed fields, signed by key
+    """
+    fields = dict((name, getattr(header, name)) for name, _ in CollationHeader.fields)
+    fields.update(changes)
+    header = CollationHeader(**fields)
+    header.sig = sign(header.signing_hash, key)
+    return header
+
+
+def test_storage_layout():
+    """Test that the view reads the same values as the public getters of the contract
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    collation = t.collate(shard_id, tester.k0)
+    t.mine(1)
+
+    state = collator.mk_header_verification_state(t.chain)
+    view = ValidatorManagerView(state)
+
+    def getter(func, args=[]):
+        return call_msg(state, get_valmgr_ct(), func, args, b'\xff' * 20, get_valmgr_addr())
+
+    assert view.num_validators == utils.big_endian_to_int(getter('get_num_validators')) == 2
+    # Two deposits, the registry nonce has no getter
+    assert view.registry_nonce == 2
+    for index in range(2):
+        valcode_addr = view.get_validation_code_addr(index)
+        assert valcode_addr == getter('get_validators__validation_code_addr', [index])[-20:]
+        assert view.get_validator_index(valcode_addr) == \
+            utils.big_endian_to_int(getter('get_validator_index_of', [valcode_addr])) == index
+    assert view.get_collation_score(shard_id, collation.header.hash) == \
+        utils.big_endian_to_int(getter('get_collation_headers__score', [shard_id, collation.header.hash])) == 1
+    assert view.get_shard_head(shard_id) == getter('get_shard_head', [shard_id]) == collation.header.hash
+    for shard_id in range(10):
+        assert view.sample(shard_id) == call_sample(state, shard_id)[-20:]
+
+
+def test_check_add_header():
+    """Differential test of ValidatorManagerView.check_add_header against add_header
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    added = t.collate(shard_id, tester.k0)
+    t.mine(5)
+
+    state = collator.mk_header_verification_state(t.chain)
+    expected_period_number = t.chain.get_expected_period_number()
+    collation = collator.create_collation(
+        t.chain, shard_id, added.header.hash, expected_period_number,
+        coinbase=tester.a0, key=tester.k0, txqueue=TransactionQueue())
+    header = collation.header
+
+    headers = [added.header]
+    for parent_collation_hash in (added.header.hash, b'\x00' * 32, utils.sha3('unknown')):
+        for key in (tester.k0, tester.k1):
+            headers.append(variant(header, key, parent_collation_hash=parent_collation_hash))
+        headers.append(variant(header, tester.k0, parent_collation_hash=parent_collation_hash,
+                               expected_period_number=expected_period_number + 1))
+        headers.append(variant(header, tester.k0, parent_collation_hash=parent_collation_hash,
+                               period_start_prevhash=utils.sha3('prevhash')))
+        bad_sig = variant(header, tester.k0, parent_collation_hash=parent_collation_hash)
+        bad_sig.sig = utils.sha3('sig') * 3
+        headers.append(bad_sig)
+
+    results = [call_add_header(state, h) for h in headers]
+    assert [check_add_header(state, h) for h in headers] == results
+    assert True in results and False in results
+
+
+def test_check_add_header_errors():
+    """Test that the bad headers and a missing contract raise ValueError
+    """
+    t = tester.Chain(env='sharding')
+    t.mine(5)
+    state = collator.mk_header_verification_state(t.chain)
+    header = CollationHeader(shard_id=1, expected_period_number=1)
+    with pytest.raises(ValueError):
+        ValidatorManagerView(state).check_add_header(CollationHeader(shard_id=-1))
+    # The contract is not deployed
+    with pytest.raises(ValueError):
+        ValidatorManagerView(state).check_add_header(header)
+    with pytest.raises(ValueError):
+        ValidatorManagerView(state).sample(1)
+    assert collator.verify_collation_headers(t.chain, [header]) == [False]
@@ -1,6 +1,6 @@
+import json
 import os
 import rlp
-import viper
 
 from ethereum import abi, utils, vm
 from ethereum.messages import apply_message
@@ -20,6 +20,10 @@ _valmgr_bytecode = None
 _valmgr_addr = None
 _valmgr_sender_addr = None
 _valmgr_tx = None
+_valmgr_artifact = None
+
+# The compiled validator manager, rebuilt when the source of the contract changes
+VALMGR_ARTIFACT_PATH = os.path.join(os.path.dirname(__file__), 'contracts/validator_manager.json')
 
 viper_rlp_decoder_tx = rlp.decode(utils.parse_as_bin("0xf90237808506fc23ac00830330888080b902246102128061000e60003961022056600060007f010000000000000000000000000000000000000000000000000000000000000060003504600060c082121515585760f882121561004d5760bf820336141558576001905061006e565b600181013560f783036020035260005160f6830301361415585760f6820390505b5b368112156101c2577f010000000000000000000000000000000000000000000000000000000000000081350483602086026040015260018501945060808112156100d55760018461044001526001828561046001376001820191506021840193506101bc565b60b881121561014357608081038461044001526080810360018301856104600137608181141561012e5760807f010000000000000000000000000000000000000000000000000000000000000060018401350412151558575b607f81038201915060608103840193506101bb565b60c08112156101b857600182013560b782036020035260005160388112157f010000000000000000000000000000000000000000000000000000000000000060018501350402155857808561044001528060b6838501038661046001378060b6830301830192506020810185019450506101ba565bfe5b5b5b5061006f565b601f841315155857602060208502016020810391505b6000821215156101fc578082604001510182826104400301526020820391506101d8565b808401610420528381018161044003f350505050505b6000f31b2d4f"), Transaction)
 viper_rlp_decoder_addr = viper_rlp_decoder_tx.creates
@@ -50,6 +54,24 @@ return(~mload(0) == {})
     return validation_code_bytecode
 
 
+def get_validation_code_signer(code):
+    """Get the address which a deployed validation code of mk_validation_code
+    verifies the signatures to, or None if the code is not made by mk_validation_code
+    """
+    init_code = mk_validation_code(b'\x00' * 20)
+    # The init code copies and returns the runtime code (PUSH2 length, DUP1, PUSH2 offset)
+    length = utils.big_endian_to_int(init_code[1:3])
+    offset = utils.big_endian_to_int(init_code[5:7])
+    runtime_code = init_code[offset: offset + length].ljust(length, b'\x00')
+    # The address is pushed by PUSH20
+    address_offset = init_code.index(b'\x73' + b'\x00' * 20) + 1 - offset
+    if len(code) != length or \
+            code[:address_offset] != runtime_code[:address_offset] or \
+            code[address_offset + 20:] != runtime_code[address_offset + 20:]:
+        return None
+    return code[address_offset: address_offset + 20]
+
+
 def sign(msg_hash, privkey):
     v, r, s = utils.ecsign(msg_hash, privkey)
     signature = utils.encode_int32(v) + utils.encode_int32(r) + utils.encode_int32(s)
@@ -57,11 +79,9 @@ def sign(msg_hash, privkey):
 
 
 def get_valmgr_ct():
-    global _valmgr_ct, _valmgr_code
+    global _valmgr_ct
     if not _valmgr_ct:
-        _valmgr_ct = abi.ContractTranslator(
-            viper.compiler.mk_full_signature(get_valmgr_code())
-        )
+        _valmgr_ct = abi.ContractTranslator(get_valmgr_artifact()['abi'])
     return _valmgr_ct
 
 
@@ -77,10 +97,88 @@ def get_valmgr_code():
 def get_valmgr_bytecode():
     global _valmgr_bytecode
     if not _valmgr_bytecode:
-        _valmgr_bytecode = viper.compiler.compile(get_valmgr_code())
+        _valmgr_bytecode = utils.decode_hex(get_valmgr_artifact()['bytecode'])
     return _valmgr_bytecode
 
 
+def get_valmgr_source_hash():
+    return utils.encode_hex(utils.sha3(get_valmgr_code()))
+
+
+def get_viper_version():
+    """The version of the installed viper, or None if it is not installed
+    """
+    # Only imported when checking an artifact, importing it is slow
+    import pkg_resources
+    try:
+        return pkg_resources.get_distribution('viper').version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def compile_valmgr_artifact():
+    """Compile the validator manager into its bytecode, ABI and deployment transaction
+    """
+    # Only imported when compiling, it takes seconds
+    import viper
+    code = get_valmgr_code()
+    bytecode = viper.compiler.compile(code)
+    tx, sender_addr, addr = mk_valmgr_tx(bytecode)
+    return {
+        'source_hash': get_valmgr_source_hash(),
+        'viper_version': get_viper_version(),
+        'bytecode': utils.encode_hex(bytecode),
+        'abi': viper.compiler.mk_full_signature(code),
+        'tx': utils.encode_hex(rlp.encode(tx)),
+        'sender': utils.encode_hex(sender_addr),
+        'address': utils.encode_hex(addr),
+    }
+
+
+def load_valmgr_artifact(path=VALMGR_ARTIFACT_PATH):
+    """Load the artifact at path, or None if it is missing, or compiled from
+    another source or by another version of the installed viper
+    """
+    try:
+        with open(path) as f:
+            artifact = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(artifact, dict) or artifact.get('source_hash') != get_valmgr_source_hash():
+        return None
+    # Without viper the artifact can not be compiled again, so any version is used
+    viper_version = get_viper_version()
+    if viper_version is not None and artifact.get('viper_version') != viper_version:
+        return None
+    return artifact
+
+
+def save_valmgr_artifact(artifact, path=VALMGR_ARTIFACT_PATH):
+    # Renamed into place, so that other processes never read a partial file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(artifact, f)
+    os.replace(tmp_path, path)
+
+
+def get_valmgr_artifact():
+    """Get the compiled validator manager, compiling and saving it only if
+    the saved artifact is missing or stale
+    """
+    global _valmgr_artifact
+    if not _valmgr_artifact:
+        artifact = load_valmgr_artifact()
+        if artifact is None:
+            artifact = compile_valmgr_artifact()
+            try:
+                save_valmgr_artifact(artifact)
+            except OSError:
+                # e.g. a read-only install, the next process compiles again
+                pass
+        _valmgr_artifact = artifact
+    return _valmgr_artifact
+
+
 def get_valmgr_addr():
     global _valmgr_addr
     if not _valmgr_addr:
@@ -115,9 +213,10 @@ def get_tx_rawhash(tx, network_id=None):
     return rawhash
 
 
-def create_valmgr_tx(gasprice=GASPRICE):
-    global _valmgr_sender_addr, _valmgr_addr, _valmgr_tx
-    bytecode = get_valmgr_bytecode()
+def mk_valmgr_tx(bytecode, gasprice=GASPRICE):
+    """Make the deployment transaction of the validator manager, which is
+    sent from the address recovered from its fixed signature
+    """
     tx = Transaction(0, gasprice, 4000000, to=b'', value=0, data=bytecode)
     tx.v = 27
     tx.r = 1000000000000000000000000000000000000000000000000000000000000000000000000000
@@ -127,14 +226,33 @@ def create_valmgr_tx(gasprice=GASPRICE):
         utils.ecrecover_to_pub(tx_rawhash, tx.v, tx.r, tx.s)
     )[-20:]
     valmgr_addr = utils.mk_contract_address(valmgr_sender_addr, 0)
+    return tx, valmgr_sender_addr, valmgr_addr
+
+
+def create_valmgr_tx(gasprice=GASPRICE):
+    global _valmgr_sender_addr, _valmgr_addr, _valmgr_tx
+    if gasprice == GASPRICE:
+        artifact = get_valmgr_artifact()
+        tx = rlp.decode(utils.decode_hex(artifact['tx']), Transaction)
+        valmgr_sender_addr = utils.decode_hex(artifact['sender'])
+        valmgr_addr = utils.decode_hex(artifact['address'])
+        # The sender is known, skip its ecrecover
+        tx.sender = valmgr_sender_addr
+        sharding_config['VALIDATOR_MANAGER_ADDRESS'] = utils.checksum_encode(valmgr_addr)
+    else:
+        tx, valmgr_sender_addr, valmgr_addr = mk_valmgr_tx(get_valmgr_bytecode(), gasprice)
     _valmgr_sender_addr = valmgr_sender_addr
     _valmgr_addr = valmgr_addr
     _valmgr_tx = tx
 
 
-def call_msg(state, ct, func, args, sender_addr, to, value=0, startgas=STARTGAS):
+def mk_msg(ct, func, args, sender_addr, to, value=0, startgas=STARTGAS):
     abidata = vm.CallData([utils.safe_ord(x) for x in ct.encode_function_call(func, args)])
-    msg = vm.Message(sender_addr, to, value, startgas, abidata)
+    return vm.Message(sender_addr, to, value, startgas, abidata)
+
+
+def call_msg(state, ct, func, args, sender_addr, to, value=0, startgas=STARTGAS):
+    msg = mk_msg(ct, func, args, sender_addr, to, value, startgas)
     result = apply_message(state.ephemeral_clone(), msg)
     if result is None:
         raise MessageFailed("Msg failed")
@@ -189,6 +307,19 @@ def call_msg_add_header(state, value, header, collator_addr):
     )
 
 
+def apply_msg_add_header(state, value, header, collator_addr):
+    """Like call_msg_add_header, but the header is added to state itself
+    """
+    msg = mk_msg(
+        get_valmgr_ct(), 'add_header', [header],
+        collator_addr, get_valmgr_addr(), value, startgas=10 ** 20
+    )
+    result = apply_message(state, msg)
+    if result is None:
+        raise MessageFailed("Msg failed")
+    return result
+
+
 def call_get_shard_head(state, shard_id):
     dummy_addr = b'\xff' * 20
     return call_msg(
@@ -261,3 +392,8 @@ def create_contract_tx(state, sender_privkey, bytecode, startgas=STARTGAS):
         data=bytecode
     ).sign(sender_privkey)
     return tx
+
+
+if __name__ == '__main__':
+    # Build the artifact ahead of time: python -m sharding.validator_manager_utils
+    save_valmgr_artifact(compile_valmgr_artifact())
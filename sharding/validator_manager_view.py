@@ -0,0 +1,211 @@
+import rlp
+
+from ethereum import utils
+from ethereum.transactions import secpk1n
+
+from sharding.validator_manager_utils import (get_valmgr_addr,
+                                              get_validation_code_signer)
+
+# The storage variables of contracts/validator_manager.v.py in declaration
+# order, viper gives each one the slot of its position
+VALMGR_STORAGE_VARIABLES = [
+    'validators',
+    'collation_headers',
+    'shard_head',
+    'num_validators',
+    'registry_nonce',
+    'deposit_size',
+    'shuffling_cycle_length',
+    'sig_gas_limit',
+    'is_valcode_deposited',
+    'validator_index_of',
+    'period_length',
+    'num_validators_per_cycle',
+    'shard_count',
+    'add_header_log_topic',
+    'sighasher_addr',
+]
+VALMGR_SLOTS = dict((name, slot) for slot, name in enumerate(VALMGR_STORAGE_VARIABLES))
+
+ZERO_ADDR = b'\x00' * 20
+MAX_HEADER_SIZE = 4096
+
+
+def child_slot(slot, key):
+    """The slot of a mapping value or of a struct member in viper storage
+
+    key: the key of the mapping, or the index of the member in the sorted member names
+    """
+    return (utils.big_endian_to_int(utils.sha3(utils.encode_int32(slot))) + key) % 2**256
+
+
+def get_index_in_subset(period_seed, shard_id, num_validators_per_cycle):
+    return utils.big_endian_to_int(
+        utils.sha3(period_seed + utils.encode_int32(shard_id))) % num_validators_per_cycle
+
+
+def get_sampled_index(cycle_seed, shard_id, index_in_subset, num_validators):
+    return utils.big_endian_to_int(utils.sha3(
+        cycle_seed + utils.encode_int32(shard_id) + utils.encode_int32(index_in_subset))) % num_validators
+
+
+class ValidatorManagerView(object):
+    """Read-only view of the storage of the validator manager contract
+
+    The rules of add_header and sample are checked in Python against the
+    storage, without running the contract in the EVM.
+
+    state: the state of the block in which the contract would be called
+    """
+
+    def __init__(self, state, address=None):
+        self.state = state
+        self.address = address or get_valmgr_addr()
+
+    def get(self, slot):
+        return self.state.get_storage_data(self.address, slot)
+
+    def get_global(self, name):
+        return self.get(VALMGR_SLOTS[name])
+
+    @property
+    def num_validators(self):
+        return self.get_global('num_validators')
+
+    @property
+    def registry_nonce(self):
+        return self.get_global('registry_nonce')
+
+    @property
+    def period_length(self):
+        return self.get_global('period_length')
+
+    @property
+    def shuffling_cycle_length(self):
+        return self.get_global('shuffling_cycle_length')
+
+    @property
+    def num_validators_per_cycle(self):
+        return self.get_global('num_validators_per_cycle')
+
+    @property
+    def shard_count(self):
+        return self.get_global('shard_count')
+
+    def get_validation_code_addr(self, validator_index):
+        # Members of validators: deposit, return_addr, validation_code_addr
+        slot = child_slot(child_slot(VALMGR_SLOTS['validators'], validator_index), 2)
+        return utils.int_to_addr(self.get(slot))
+
+    def get_validator_index(self, validation_code_addr):
+        return self.get(child_slot(VALMGR_SLOTS['validator_index_of'], utils.big_endian_to_int(validation_code_addr)))
+
+    def get_collation_score(self, shard_id, collation_hash):
+        # Members of collation_headers: parent_collation_hash, score
+        slot = child_slot(VALMGR_SLOTS['collation_headers'], shard_id)
+        slot = child_slot(child_slot(slot, utils.big_endian_to_int(collation_hash)), 1)
+        return self.get(slot)
+
+    def get_shard_head(self, shard_id):
+        return utils.encode_int32(self.get(child_slot(VALMGR_SLOTS['shard_head'], shard_id)))
+
+    def blockhash(self, block_number):
+        """The BLOCKHASH opcode
+        """
+        state = self.state
+        if 1 <= state.block_number - block_number <= 256 and block_number <= state.block_number:
+            return state.get_block_hash(state.block_number - block_number - 1)
+        return b'\x00' * 32
+
+    def get_cycle_seed(self):
+        """The seed of the shuffling cycle of the current block
+        """
+        block_number = self.state.block_number
+        cycle_length = self.shuffling_cycle_length
+        return self.blockhash(max(block_number // cycle_length * cycle_length - 1, 0))
+
+    def get_period_seed(self, period_number=None):
+        """The seed of a period, the hash of the block before its start
+        """
+        if period_number is None:
+            period_number = self.state.block_number // self.period_length
+        return self.blockhash(period_number * self.period_length - 1)
+
+    def check_storage(self):
+        """Raise ValueError if the contract is not deployed in state, or its
+        storage is not initialized
+        """
+        if not self.state.get_code(self.address):
+            raise ValueError('Validator manager is not deployed')
+        if self.period_length == 0 or self.shuffling_cycle_length == 0 or self.num_validators_per_cycle == 0:
+            raise ValueError('Validator manager storage is not initialized')
+
+    def sample(self, shard_id):
+        """The sample function of the contract
+        """
+        self.check_storage()
+        if self.state.block_number < self.period_length:
+            raise ValueError('Sampling before the first period')
+        index_in_subset = get_index_in_subset(self.get_period_seed(), shard_id, self.num_validators_per_cycle)
+        num_validators = self.num_validators
+        if num_validators == 0:
+            return ZERO_ADDR
+        return self.get_validation_code_addr(
+            get_sampled_index(self.get_cycle_seed(), shard_id, index_in_subset, num_validators))
+
+    def check_add_header(self, header):
+        """Check the rules of add_header for a collation header,
+        raise ValueError if add_header would fail
+
+        The signature is only checked if the validation code of the sampled
+        collator is made by mk_validation_code, otherwise add_header has to run it.
+        """
+        # The fields are checked before encoding, rlp can not encode negative numbers
+        if header.shard_id < 0 or header.shard_id >= 2**256:
+            raise ValueError('Invalid shard_id %d' % header.shard_id)
+        if header.expected_period_number < 0 or header.expected_period_number >= 2**256:
+            raise ValueError('Invalid expected_period_number %d' % header.expected_period_number)
+        try:
+            header_size = len(rlp.encode(header))
+        except rlp.RLPException as e:
+            raise ValueError('Invalid header: %s' % str(e))
+        if header_size > MAX_HEADER_SIZE:
+            raise ValueError('Header is too large')
+        self.check_storage()
+        block_number = self.state.block_number
+        period_length = self.period_length
+        if block_number < period_length:
+            raise ValueError('Adding header before the first period')
+        if header.expected_period_number != block_number // period_length:
+            raise ValueError('Wrong expected_period_number %d' % header.expected_period_number)
+        if header.period_start_prevhash != self.blockhash(header.expected_period_number * period_length - 1):
+            raise ValueError('Wrong period_start_prevhash')
+        if self.get_collation_score(header.shard_id, header.hash) != 0:
+            raise ValueError('Header already exists')
+        if header.parent_collation_hash != b'\x00' * 32 and \
+                self.get_collation_score(header.shard_id, header.parent_collation_hash) == 0:
+            raise ValueError('Parent collation does not exist')
+
+        collator_valcode_addr = self.sample(header.shard_id)
+        if collator_valcode_addr == ZERO_ADDR:
+            raise ValueError('No collator is sampled')
+        signer = get_validation_code_signer(self.state.get_code(collator_valcode_addr))
+        if signer is not None and recover_signer(header.signing_hash, header.sig) != signer:
+            raise ValueError('Header is not signed by the sampled collator')
+        return True
+
+
+def recover_signer(msg_hash, sig):
+    """The address recovered by the validation code of mk_validation_code, or None
+    """
+    sig = sig[:96].ljust(96, b'\x00')
+    v = utils.big_endian_to_int(sig[0:32])
+    r = utils.big_endian_to_int(sig[32:64])
+    s = utils.big_endian_to_int(sig[64:96])
+    # The ecrecover precompile rejects these signatures
+    if v not in (27, 28) or not 0 < r < secpk1n or not 0 < s < secpk1n:
+        return None
+    try:
+        return utils.sha3(utils.ecrecover_to_pub(msg_hash, v, r, s))[-20:]
+    except Exception:
+        return None